@@ -1,12 +1,22 @@
 import logging
 import datetime
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 from craigslist import CraigslistHousing
 
 from utils.base_utils import * 
+from utils.score_utils import column_score, max_score, geometric_mean_array
+from utils.crawl_utils import get_query_key, pull_data_concurrent, pull_data_incremental, pull_data_two_phase, \
+    mark_seen, CraigslistHousingRows, DetailFetcher
+from utils.plan_utils import filter_mask
+from utils.site_utils import validate_site_area
+from utils.metrics_utils import RunMetrics
+from utils.isochrone_utils import get_isochrone_grid
 from constants import *
-from cachier import cachier
+from utils.cache_utils import cached
 
 logging.root.setLevel(logging.DEBUG)
 
@@ -15,6 +25,7 @@ class HousingCrawler(object):
                  site=None,
                  area=None,
                  n_beds=None, 
+                 n_beds_max=None, 
                  price_min=None, 
                  price_max=None, 
                  area_min=None, 
@@ -22,7 +33,15 @@ class HousingCrawler(object):
                  filters=None,
                  destination=None,
                  mode=None,
-                 limit=None
+                 limit=None,
+                 max_workers=TRAVEL_MAX_WORKERS,
+                 incremental=False,
+                 two_phase=False,
+                 ppsqft_max=None,
+                 prune_travel=True,
+                 isochrones=True,
+                 lazy=False,
+                 metrics=None
                 ):
         """filters take precedence"""
         if filters is None:
@@ -30,7 +49,12 @@ class HousingCrawler(object):
 
         self.site = site if site is not None else filters['site']
         self.area = area if area is not None else filters['area']
+        # fail before any network call if the site or area does not exist
+        validate_site_area(self.site, self.area)
         self.n_beds = n_beds if n_beds is not None else filters['min_bedrooms']
+        if n_beds_max is None:
+            n_beds_max = filters.get('max_bedrooms') if filters is not None else None
+        self.n_beds_max = n_beds_max if n_beds_max is not None else self.n_beds
         self.price_min = price_min if price_min is not None else filters['price_min']
         self.price_max = price_max if price_max is not None else filters['price_max']
         self.area_min = area_min if area_min is not None else filters['min_ft2']
@@ -39,27 +63,78 @@ class HousingCrawler(object):
         self.destination = destination
         self.mode = mode 
         self.limit = limit
+        self.max_workers = max_workers # maximum number of concurrent travel requests
+        self.incremental = incremental # only crawl listings that are new or updated since the last crawl
+        self.two_phase = two_phase # only fetch details of search results passing the prefilter
+        # search results above ppsqft_max are not crawled (two_phase only), by default those whose ppsqft score is 0
+        if ppsqft_max is None and two_phase:
+            ppsqft_max = SCORE_BOUNDS['ppsqft']['max']
+        self.ppsqft_max = ppsqft_max
+        self.prune_travel = prune_travel # skip travel lookups whose lower bound already scores 0
+        self.isochrones = isochrones # interpolate travel data from the isochrone grid of the area when it was built
+        self.lazy = lazy # only pull travel data of listings that can still score above 0 (see score_lazy)
+        # measures of the stages of the run (shared with subsets)
+        self.metrics = metrics if metrics is not None else RunMetrics(caches=self.get_metric_caches())
         
         # others attributes 
         self.res = None # results of crawling 
         self.df_res = None # results in dataframe 
         
         
-    def pull_data(self):
-        # filters
+    @staticmethod
+    def get_metric_caches():
+        """Returns the caches whose hits and misses are reported in the metrics of runs."""
+        return {
+            'crawl': HousingCrawler._pull_data_fromcraig.cache,
+            'crawl_two_phase': HousingCrawler._pull_data_two_phase.cache,
+            'travel_info': get_travel_info.cache,
+            'travel_store': TRAVEL_STORE
+        }
+
+    def get_metric_labels(self):
+        """Returns the labels of the metrics of the stages of the crawler."""
+        return {
+            'site': self.site,
+            'area': self.area or '',
+            'title': (self.filters or {}).get('title') or ''
+        }
+
+    def get_crawl_filters(self):
+        """Returns the craigslist filters of the crawl."""
         filters={'min_price': self.price_min,
           'max_price': self.price_max,
           'min_bedrooms': self.n_beds,
-          'max_bedrooms': self.n_beds,
+          'max_bedrooms': self.n_beds_max,
           'min_ft2': self.area_min,
           'posted_today': self.posted_today
          }
+        return filters
+
+    def pull_data(self):
+        # filters
+        filters = self.get_crawl_filters()
 
-        res = self._pull_data_fromcraig(
-            filters=filters, 
-            site=self.site, 
-            area=self.area, 
-            limit=self.limit)
+        if self.incremental:
+            res = self._pull_data_incremental(
+                filters=filters, 
+                site=self.site, 
+                area=self.area, 
+                limit=self.limit)
+        elif self.two_phase:
+            res = self._pull_data_two_phase(
+                filters=filters, 
+                site=self.site, 
+                area=self.area, 
+                limit=self.limit,
+                ppsqft_max=self.ppsqft_max)
+            logging.info({'msg': 'crawl cache stats', 'stats': self._pull_data_two_phase.cache.get_stats()})
+        else:
+            res = self._pull_data_fromcraig(
+                filters=filters, 
+                site=self.site, 
+                area=self.area, 
+                limit=self.limit)
+            logging.info({'msg': 'crawl cache stats', 'stats': self._pull_data_fromcraig.cache.get_stats()})
 
         logging.info({'msg': 'Number of listings for {n_beds} bedrooms is: {n_obs}'.format(
             n_beds=self.n_beds,
@@ -68,49 +143,35 @@ class HousingCrawler(object):
         # add to self
         self.res = res
         return res
+
+    @staticmethod
+    def format_records(records):
+        """
+        Converts crawled records into a clean DataFrame (see normalize_listings).
+
+        :params records: list of dicts of listings
+        """
+        # list of columns that we care about 
+        l_COLUMNS = ['id', 'url', 'datetime', 'created', 'last_updated', 'lat', 'lng', 'price', 'area', 'bedrooms', 'bathrooms']
+        # typed columns built directly from records (lat and lng from geotag)
+        df_res = records_to_frame(records, l_columns=l_COLUMNS + ['body'])
+        
+        # clean and type columns, add ppsqft, lat_key, lng_key and exclude listings with small description
+        df_res = normalize_listings(df_res, l_columns=l_COLUMNS, thresh=10)
+        return df_res
     
     def format_data(self):
         assert self.res is not None
-        df_res = pd.DataFrame.from_dict(self.res)
-        
-        # exclude listing with small description 
-        df_res = exclude_smalldesc(df_res, thresh=10)
-        
-        # list of columns that we care about 
-        l_COLUMNS = ['id', 'url', 'datetime', 'created', 'last_updated', 'geotag', 'price', 'area', 'bedrooms', 'bathrooms']
-        
-        # only keep column we care about 
-        df_res = df_res[l_COLUMNS]
-        
-        # clean area column 
-        df_res = clean_area(df_res)
-
-        # clean price column
-        df_res = clean_price(df_res)
-
-        # remove rows with None 
-        df_res = remove_None(df_res)
-
-        # calculate the price per sqft 
-        df_res['ppsqft'] = df_res.price / df_res.area
-
-        # get lat, lng 
-        df_res['lat'] = df_res.geotag.apply(get_lat)
-        df_res['lng'] = df_res.geotag.apply(get_lng)
-
-        # we add a column of rounded latlng for caching purpose 
-        df_res['geotag_rounded'] = df_res.geotag.apply(
-            lambda x : (round(x[0], 4), round(x[1], 4))
-            )
+        df_res = self.format_records(self.res)
 
         # sort by ppsqft
         df_res.sort_values(['ppsqft'], inplace = True)
         
         self.df_res = df_res     
-        
-    def enrich_traveldata(self, destination=None, mode=None):
+
+    def set_destinations_modes(self, destination=None, mode=None):
         """
-        Adds columns about the distance and duration to destination based on mode of transport.
+        Sets the destinations (dict) and modes (list) of travel data.
 
         :params destination: dict with keys (lat, lng) of destination or dict with keys refering to names of destinations
         and values dicts with (lat, lng) as keys
@@ -119,8 +180,6 @@ class HousingCrawler(object):
         destination = self.destination if destination is None else destination
         mode = self.mode if mode is None else mode
 
-        assert self.df_res is not None 
-        assert self.df_res.shape[0] != 0, "df_res has no data"
         assert isinstance(destination, dict), "destination is either must be dict, {} given".format(type(destination))
         assert type(mode) in [list, str], "mode is either a list or a str"
         
@@ -135,35 +194,122 @@ class HousingCrawler(object):
 
         self.d_destinations = d_destinations
         self.l_modes = l_modes
+        
+    def enrich_traveldata(self, destination=None, mode=None):
+        """
+        Adds columns about the distance and duration to destination based on mode of transport.
 
-        for dest_name, dest_lat_lng in d_destinations.items():
-            for mode_ in l_modes:
-                # column for distance_duration columns (temporaty column)
-                dist_dur_colname = "_".join(["dist_dur", str(dest_name), str(mode_)])
-                
-                logging.info(
-                    {
-                    'msg': 'pulling travel data for traveling to {dest_name} using {mode_}'.format(
-                        dest_name=dest_name,
-                        mode_=mode_
-                        )
-                    }
-                )
-                self.df_res[dist_dur_colname] = self.df_res.geotag_rounded.apply(
-                    lambda x: get_travel_info(x, destination=dest_lat_lng, mode=mode_)
+        :params destination: dict with keys (lat, lng) of destination or dict with keys refering to names of destinations
+        and values dicts with (lat, lng) as keys
+        :params mode: can take one or a subset of ["walking", "transit", "bicycling", "driving"]
+        """
+        assert self.df_res is not None 
+        assert self.df_res.shape[0] != 0, "df_res has no data"
+        self.set_destinations_modes(destination=destination, mode=mode)
+
+        logging.info(
+            {
+            'msg': 'pulling travel data for traveling to {dest_names} using {l_modes}'.format(
+                dest_names=list(self.d_destinations.keys()),
+                l_modes=self.l_modes
                 )
-                
+            }
+        )
+        # listings sharing the same rounded coordinates are looked up once
+        _, l_origins = get_origins(self.df_res)
+        logging.info({'msg': 'Number of unique origins: {n_origins} for {n_rows} listings'.format(
+            n_origins=len(l_origins),
+            n_rows=self.df_res.shape[0]
+        )})
+
+        # all batched lookups (all modes and destinations) are sent concurrently
+        d_travel = get_travel_matrix(
+            l_origins, destinations=self.d_destinations, l_modes=self.l_modes, max_workers=self.max_workers,
+            d_known=self.get_known_travel(l_origins)
+            )
+        self.assign_traveldata(d_travel)
+
+    def get_known_travel(self, l_origins, destinations=None, l_modes=None):
+        """
+        Returns the travel lookups of l_origins that are not sent to the travel API: interpolations of the isochrone
+        grid of the area (see scripts/build_isochrones.py) and missing values for the lookups that can't score above 0.
+
+        :params l_origins: list of tuples (lat, lng) of origins
+        :params destinations: dict of destinations (default: all destinations)
+        :params l_modes: list of modes of transportation (default: all modes)
+
+        :output d_known: dict with keys (origin, dest_name, mode) and values (distance, duration)
+        """
+        destinations = self.d_destinations if destinations is None else destinations
+        l_modes = self.l_modes if l_modes is None else l_modes
+        d_known = dict()
+        grid = get_isochrone_grid(self.site, self.area) if self.isochrones else None
+        if grid is not None:
+            d_known.update(grid.lookup(l_origins, destinations=destinations, l_modes=l_modes))
+        d_known.update(self.prune_travel_lookups(l_origins, destinations=destinations, l_modes=l_modes) or {})
+        return d_known
+
+    def prune_travel_lookups(self, l_origins, destinations=None, l_modes=None):
+        """
+        Returns missing values (NaN) for the travel lookups of l_origins that can't score above 0 (None if prune_travel
+        is False). Their exact duration is at least the lower bound of TravelEstimator.prune so their score is 0 either
+        way, as the score of a missing duration. The bounds are not returned so that they are not stored as travel data.
+
+        :params l_origins: list of tuples (lat, lng) of origins
+        :params destinations: dict of destinations (default: all destinations)
+        :params l_modes: list of modes of transportation (default: all modes)
+        """
+        if not self.prune_travel:
+            return None
+        destinations = self.d_destinations if destinations is None else destinations
+        l_modes = self.l_modes if l_modes is None else l_modes
+        d_pruned = TRAVEL_ESTIMATOR.prune(l_origins, destinations=destinations, l_modes=l_modes)
+        return {key: (np.nan, np.nan) for key in d_pruned}
+
+    def get_travel_array(self, df, dest_name, mode):
+        """
+        Returns the distance and duration from the listings of df to dest_name using mode.
+
+        :params df: DataFrame of listings (with lat_key, lng_key)
+        :params dest_name: name of the destination in d_destinations
+        :params mode: mode of transportation
+
+        :output arr_dist_dur: np array (rows of df x 2) of distances and durations
+        """
+        origin_codes, l_origins = get_origins(df)
+        destinations = {dest_name: self.d_destinations[dest_name]}
+        d_travel = get_travel_matrix(
+            l_origins, destinations=destinations, l_modes=[mode], max_workers=self.max_workers,
+            d_known=self.get_known_travel(l_origins, destinations=destinations, l_modes=[mode])
+            )
+        arr_dist_dur = np.array([d_travel[(x, dest_name, mode)] for x in l_origins], dtype=float).reshape(-1, 2)
+        return arr_dist_dur[origin_codes]
+
+    def assign_traveldata(self, d_travel):
+        """
+        Adds the distance and duration columns of all destinations and modes to df_res in one pass.
+
+        :params d_travel: dict with keys (origin, dest_name, mode) and values (distance, duration)
+        """
+        logging.info({'msg': 'travel API rate limiter stats', 'stats': TRAVEL_RATE_LIMITER.get_stats()})
+        logging.info({'msg': 'http session stats', 'stats': get_session_stats()})
+        logging.info({'msg': 'travel store stats', 'stats': TRAVEL_STORE.get_stats()})
+
+        # results of unique origins are fanned out to listings
+        origin_codes, l_origins = get_origins(self.df_res)
+
+        d_columns = dict()
+        for dest_name in self.d_destinations.keys():
+            for mode_ in self.l_modes:
+                arr_dist_dur = np.array([d_travel[(x, dest_name, mode_)] for x in l_origins], dtype=float).reshape(-1, 2)
                 # distance column
                 dist_colname = "_".join(["distance", str(dest_name), str(mode_)])
-                self.df_res[dist_colname] = self.df_res[dist_dur_colname].apply(lambda x: x[0])
-                
+                d_columns[dist_colname] = arr_dist_dur[origin_codes, 0]
                 # duration column
                 dur_colname = "_".join(["duration", str(dest_name), str(mode_)])
-                self.df_res[dur_colname] = self.df_res[dist_dur_colname].apply(lambda x: x[1])
-                
-                # drop dist_dur column 
-                self.df_res.drop([dist_dur_colname], axis=1, inplace=True)
-                
+                d_columns[dur_colname] = arr_dist_dur[origin_codes, 1]
+
+        self.df_res = self.df_res.assign(**d_columns)
 
     def get_travel_score(self):
         """Gets aggregate scores for each destination and travel score for each destination and modes."""
@@ -171,35 +317,30 @@ class HousingCrawler(object):
         assert isinstance(self.l_modes, list), "You must run enrich_traveldata to get travel data"
 
         for dest_name in self.d_destinations.keys():
+            l_mode_scores = []
             for mode_ in self.l_modes:
-                # get the score of going to dest_name using mode_
+                # get the score of going to dest_name using mode_ (failed lookups score 0)
                 col_name = '_'.join(["duration", dest_name, mode_])
                 score_name = '_'.join([mode_, dest_name, "score"])
-                self.df_res[score_name] = self.df_res[col_name].apply(
-                    lambda x: self.get_column_score(val=x, val_name=mode_)
-                    )
+                self.df_res[score_name] = column_score(self.df_res[col_name], val_name=mode_, missing=0.)
+                l_mode_scores.append(self.df_res[score_name].values)
 
             # the travel score is the max of all mode scores
             travel_score_name = '_'.join(["travel", dest_name, "score"])
-            # list of all
-            l_mode_scores = ['_'.join([mode_, dest_name, "score"]) for mode_ in self.l_modes]
-            # the travel score is the max of all mode scores
-            self.df_res[travel_score_name] = self.df_res[l_mode_scores].max(axis=1)
+            self.df_res[travel_score_name] = max_score(l_mode_scores)
 
     def get_ppsqft_score(self):
         """Gets the score of the ppsqft column."""
         col_name = "ppsqft"
         score_name = "ppsqft_score"
-        self.df_res[score_name] = self.df_res[col_name].apply(
-            lambda x: self.get_column_score(val=x, val_name="ppsqft")
-            )
+        self.df_res[score_name] = column_score(self.df_res[col_name], val_name="ppsqft")
 
     def get_aggregate_score(self):
         """Aggregate scores is the geometric means of adhoc and travel scores."""
         l_adhoc_scores = ["ppsqft_score"]
         l_travel_scores = ['_'.join(["travel", dest_name, "score"]) for dest_name in self.d_destinations.keys()]
         l_all_scores =  l_adhoc_scores + l_travel_scores
-        self.df_res['score'] = self.df_res[l_all_scores].apply(geometric_mean, axis = 1)
+        self.df_res['score'] = geometric_mean_array(self.df_res[l_all_scores].values)
 
     def score(self):
         assert self.df_res is not None, 'You must first run pull_data and enrich_traveldata to get scores'
@@ -213,6 +354,56 @@ class HousingCrawler(object):
         # total score is the geometric mean of ppsqft score, travel Uber score and travel Dropbox score 
         self.get_aggregate_score()
 
+        self.rank_results()
+
+    def score_lazy(self):
+        """
+        Pulls travel data and scores listings, only pulling travel data that can change a score:
+        listings with a ppsqft score of 0 are not enriched, destinations are evaluated in order and a listing stops
+        at its first travel score of 0, and the remaining modes of a destination are skipped once a mode scores 1.
+        Scores are the same as enrich_traveldata then score; travel data and scores that were skipped are missing.
+        """
+        assert self.df_res is not None, 'You must first run pull_data to get scores'
+        n_rows = self.df_res.shape[0]
+        ppsqft_score = column_score(self.df_res['ppsqft'], val_name='ppsqft')
+        # listings that can still score above 0
+        alive = ppsqft_score > 0
+
+        d_travel_columns = dict()
+        d_score_columns = {'ppsqft_score': ppsqft_score}
+        l_travel_scores = []
+        for dest_name in self.d_destinations.keys():
+            travel_score = np.full(n_rows, np.nan)
+            travel_score[alive] = 0
+            for mode_ in self.l_modes:
+                # the travel score is the max of all mode scores: listings at 1 are done
+                pending = alive & (travel_score < 1)
+                logging.info({'msg': 'pulling travel data to {} using {} for {} listings out of {}'.format(
+                    dest_name, mode_, pending.sum(), n_rows)})
+                arr_dist_dur = np.full((n_rows, 2), np.nan)
+                mode_score = np.full(n_rows, np.nan)
+                if pending.any():
+                    arr_dist_dur[pending] = self.get_travel_array(self.df_res[pending], dest_name, mode_)
+                    mode_score[pending] = column_score(arr_dist_dur[pending, 1], val_name=mode_, missing=0.)
+                    travel_score[pending] = np.maximum(travel_score[pending], mode_score[pending])
+                d_travel_columns["_".join(["distance", str(dest_name), str(mode_)])] = arr_dist_dur[:, 0]
+                d_travel_columns["_".join(["duration", str(dest_name), str(mode_)])] = arr_dist_dur[:, 1]
+                d_score_columns['_'.join([mode_, dest_name, "score"])] = mode_score
+            d_score_columns['_'.join(["travel", dest_name, "score"])] = travel_score
+            l_travel_scores.append(travel_score)
+            # the geometric mean is 0 as soon as one score is 0
+            alive = alive & (travel_score > 0)
+
+        score = np.zeros(n_rows)
+        if alive.any():
+            score[alive] = geometric_mean_array(np.column_stack([ppsqft_score] + l_travel_scores)[alive])
+        d_score_columns['score'] = score
+        self.df_res = self.df_res.assign(**d_travel_columns).assign(**d_score_columns)
+
+        self.rank_results()
+
+    def rank_results(self):
+        """Sorts listings by score and sets the listings considered (score above 0) and the top 5 listings."""
         # sort values by score
         self.df_res.sort_values(['score'], ascending = False, inplace = True)
         
@@ -223,18 +414,47 @@ class HousingCrawler(object):
         self.url_top = self.df_res.url.head(5).to_list()
 
     @staticmethod
-    @cachier(stale_after=datetime.timedelta(days=30), cache_dir=CACHE_DIR)
+    @cached(stale_after=datetime.timedelta(days=30), cache_dir=CACHE_DIR)
     def _pull_data_fromcraig(filters, site, area, day=datetime.date.today(), limit=None):
-        # TODO: add assertion if site and area exist
-
         # create craig class
         cl_h = CraigslistHousing(
             site=site,
             area=area,
             filters=filters
             )
-        res_gen = cl_h.get_results(limit=limit, include_details=True, geotagged=True)
-        res = list(res_gen)
+        # details are fetched concurrently
+        res = pull_data_concurrent(cl_h, limit=limit)
+        return res
+
+    @staticmethod
+    @cached(stale_after=datetime.timedelta(days=30), cache_dir=CACHE_DIR)
+    def _pull_data_two_phase(filters, site, area, day=datetime.date.today(), limit=None, ppsqft_max=None):
+        """Pulls search results and only fetches details of the results that pass the prefilter."""
+        cl_h = CraigslistHousingRows(
+            site=site,
+            area=area,
+            filters=filters
+            )
+        res = pull_data_two_phase(
+            cl_h,
+            limit=limit,
+            price_min=filters.get('min_price'),
+            price_max=filters.get('max_price'),
+            area_min=filters.get('min_ft2'),
+            ppsqft_max=ppsqft_max
+            )
+        return res
+
+    @staticmethod
+    def _pull_data_incremental(filters, site, area, limit=None):
+        """Pulls the listings that are new or updated since the previous crawls of the same query (not cached)."""
+        cl_h = CraigslistHousing(
+            site=site,
+            area=area,
+            filters=filters
+            )
+        query = get_query_key(filters=filters, site=site, area=area)
+        res = pull_data_incremental(cl_h, query=query, limit=limit, stop_after=INCREMENTAL_STOP_AFTER)
         return res
 
     @staticmethod
@@ -259,12 +479,168 @@ class HousingCrawler(object):
         norm_val = self.normalize_val(val, min_bound=min_val, max_bound=max_val)
         return norm_val
 
-    def run_all(self):
+    def set_empty_results(self):
+        """Sets empty results when no listings were crawled."""
+        self.df_res = pd.DataFrame(columns=['id', 'url', 'score'])
+        self.url_considered = []
+        self.url_top = []
+
+    def subset(self, filters, score=True):
+        """
+        Returns a HousingCrawler holding the listings of df_res matching filters (with their travel data).
+        Used to share one crawl and enrichment between filters on the same site and area.
+
+        :params filters: filter dict whose bounds are included in the bounds of self
+        :params score: score the listings of the subset
+        """
+        hc = HousingCrawler(
+            filters=filters,
+            destination=self.destination,
+            mode=self.mode,
+            limit=self.limit,
+            max_workers=self.max_workers,
+            incremental=self.incremental,
+            two_phase=self.two_phase,
+            ppsqft_max=self.ppsqft_max,
+            prune_travel=self.prune_travel,
+            isochrones=self.isochrones,
+            lazy=self.lazy,
+            metrics=self.metrics
+            )
+        hc.res = self.res
+        mask = filter_mask(self.df_res, filters) if self.df_res is not None and self.df_res.shape[0] > 0 else None
+        if mask is None or mask.sum() == 0:
+            hc.set_empty_results()
+            return hc
+
+        hc.df_res = self.df_res[mask].copy()
+        hc.d_destinations = self.d_destinations
+        hc.l_modes = self.l_modes
+        if score:
+            with hc.metrics.stage('score_lazy' if hc.lazy else 'score', **hc.get_metric_labels()) as record:
+                hc.score_lazy() if hc.lazy else hc.score()
+                record['rows'] = hc.df_res.shape[0]
+        return hc
+
+    def run_streaming(self, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Pulls, formats and enriches listings chunk by chunk: travel data of the unique origins of a chunk
+        is pulled while the next chunk is crawled. Listings are not scored.
+
+        :params chunk_size: number of listings per chunk
+        """
+        self.set_destinations_modes()
+        cl_h = CraigslistHousing(
+            site=self.site,
+            area=self.area,
+            filters=self.get_crawl_filters()
+            )
+        # search results are read lazily, details of each chunk are fetched concurrently
+        res_gen = cl_h.get_results(limit=self.limit)
+        fetcher = DetailFetcher(cl_h)
+
+        self.res = []
+        l_df = []
+        l_futures = []
+        set_origins = set()
+        # travel lookups run in the background (get_travel_matrix has its own pool of workers)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for chunk in iter(lambda: fetcher.fetch_all(list(itertools.islice(res_gen, chunk_size))), []):
+                df_chunk = self.format_records(chunk)
+                # index of the listings in the whole crawl
+                df_chunk.index += len(self.res)
+                self.res.extend(chunk)
+                if df_chunk.shape[0] == 0:
+                    continue
+                l_df.append(df_chunk)
+
+                # only origins that were not submitted yet
+                l_new_origins = [x for x in get_origins(df_chunk)[1] if x not in set_origins]
+                set_origins.update(l_new_origins)
+                if len(l_new_origins) > 0:
+                    l_futures.append(executor.submit(
+                        get_travel_matrix, l_new_origins, destinations=self.d_destinations, l_modes=self.l_modes,
+                        max_workers=self.max_workers, d_known=self.get_known_travel(l_new_origins)
+                        ))
+                logging.info({'msg': 'Number of listings crawled: {}'.format(len(self.res))})
+
+            d_travel = dict()
+            for future in l_futures:
+                d_travel.update(future.result())
+
+        if len(l_df) == 0:
+            return
+
+        self.df_res = pd.concat(l_df, axis=0)
+        # sort by ppsqft
+        self.df_res.sort_values(['ppsqft'], inplace = True)
+        self.assign_traveldata(d_travel)
+
+    def run_all(self, score=True, stream=False, mark_seen=True):
+        """
+        Pulls, formats, enriches and scores listings.
+
+        :params score: score the listings
+        :params mark_seen: mark the listings of an incremental crawl as crawled at the end of the run
+        (False if they are processed further, e.g. pushed, then call mark_seen once they are)
+        :params stream: overlap crawling and travel lookups (see run_streaming, the crawl cache is not used)
+        (travel data of all listings is pulled even if lazy)
+        """
+        labels = self.get_metric_labels()
+        if stream:
+            # search pages are requested by python-craigslist, outside of the shared session
+            with self.metrics.stage('run_streaming', count_http=False, **labels) as record:
+                self.run_streaming()
+                record['rows'] = len(self.res)
+            if self.df_res is None:
+                logging.info({'msg': 'No listings to process'})
+                self.set_empty_results()
+            elif score:
+                with self.metrics.stage('score', **labels) as record:
+                    self.score()
+                    record['rows'] = self.df_res.shape[0]
+            return
+
         # pull data 
-        _ = self.pull_data()
+        # search pages are requested by python-craigslist, outside of the shared session
+        with self.metrics.stage('pull_data', count_http=False, **labels) as record:
+            res = self.pull_data()
+            record['rows'] = len(res)
+        if len(res) == 0:
+            logging.info({'msg': 'No listings to process'})
+            self.set_empty_results()
+            return
         # format data 
-        self.format_data()
+        with self.metrics.stage('format_data', **labels) as record:
+            self.format_data()
+            record['rows'] = self.df_res.shape[0]
+        if self.lazy:
+            # travel data is pulled while scoring (see score_lazy)
+            self.set_destinations_modes()
+            if score:
+                with self.metrics.stage('score_lazy', **labels) as record:
+                    self.score_lazy()
+                    record['rows'] = self.df_res.shape[0]
+            if mark_seen:
+                self.mark_seen()
+            return
         # enrich travel data 
-        self.enrich_traveldata()
+        with self.metrics.stage('enrich_traveldata', **labels) as record:
+            self.enrich_traveldata()
+            record['rows'] = self.df_res.shape[0]
         # get score 
-        self.score()
\ No newline at end of file
+        if score:
+            with self.metrics.stage('score', **labels) as record:
+                self.score()
+                record['rows'] = self.df_res.shape[0]
+        if mark_seen:
+            self.mark_seen()
+
+    def mark_seen(self):
+        """
+        Marks the listings of an incremental crawl as crawled (see crawl_utils.mark_seen), once the run processed them:
+        listings of a run that failed before are crawled again by the next run.
+        """
+        if not self.incremental or not self.res:
+            return
+        mark_seen(get_query_key(filters=self.get_crawl_filters(), site=self.site, area=self.area), self.res)
\ No newline at end of file
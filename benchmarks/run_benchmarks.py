@@ -0,0 +1,284 @@
+"""
+Offline end-to-end benchmark of HousingCrawler.run_all and the sinks.
+
+Craigslist, the Distance Matrix API, SendGrid and Firebase are replaced by local stub servers (see stub_servers)
+with configurable latency and error rate, and listings are synthetic (see synthetic). Each scale runs in its own
+process with empty caches; the time, throughput, peak memory (tracemalloc) and API calls of each stage are reported.
+
+Usage (from the root of the repo):
+    python -m benchmarks.run_benchmarks --scales 100 1000 10000 100000 --latency 0.01 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import generate_listings, to_record
+from benchmarks.stub_servers import CraigslistStub, DistanceMatrixStub, SendGridStub, FirebaseStub
+
+FILTERS = {
+    'title': 'benchmark',
+    'site': 'sfbay',
+    'area': 'sfc',
+    'price_min': 0,
+    'price_max': 1000000,
+    'min_bedrooms': 0,
+    'max_bedrooms': 10,
+    'min_ft2': 0
+}
+DESTINATION = {
+    'Uber': {'lat': 37.775905, 'lng': -122.418339},
+    'Dropbox': {'lat': 37.766622, 'lng': -122.392408}
+}
+MODES = ['bicycling', 'transit', 'walking']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of HousingCrawler against stub servers')
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='numbers of listings')
+    parser.add_argument('--crawl-max', type=int, default=1000,
+                        help='maximum number of listings crawled through the craigslist stub, '
+                             'listings above it are added to the crawl results directly')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='latency (seconds) of each response of the stub servers')
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help='probability of an error response (listing pages, travel API, sinks)')
+    parser.add_argument('--detail-delay', type=float, default=0.,
+                        help='delay (seconds) between two requests to craigslist (DETAIL_FETCH delay)')
+    parser.add_argument('--travel-rate', type=float, default=1000.,
+                        help='requests per second allowed by the travel API rate limiter')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic listings')
+    parser.add_argument('--lazy', action='store_true',
+                        help='pull travel data while scoring, only for listings that can score above 0 (score_lazy)')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory (tracemalloc slows down runs)')
+    parser.add_argument('--output', help='path of the json report')
+    # internal: run a single scale in the current process and write its report to --result
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+class NullCursor(object):
+    """Cursor reading the data sent by COPY without a database (measures the serialization of the postgres sink)."""
+    def __init__(self):
+        self.n_bytes = 0
+
+    def copy_expert(self, statement, file):
+        chunk = file.read(65536)
+        while chunk:
+            self.n_bytes += len(chunk)
+            chunk = file.read(65536)
+
+
+def diff_counters(before, after):
+    return {key: value - before.get(key, 0) for key, value in after.items() if value - before.get(key, 0) != 0}
+
+
+def run_stage(report, name, func, d_stubs, trace_memory):
+    """
+    Runs func as a stage of the benchmark and appends its measures to report["stages"].
+    func returns the number of rows it processed. Stages whose dependencies are not installed are skipped
+    and stages raising an error (e.g. a sink without retries getting error responses) are reported as failed.
+    """
+    d_before = {stub_name: stub.get_counters() for stub_name, stub in d_stubs.items()}
+    if trace_memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        n_rows = func()
+    except ImportError as e:
+        report['stages'].append({'stage': name, 'skipped': str(e)})
+        return
+    except Exception as e:
+        report['stages'].append({'stage': name, 'failed': repr(e)})
+        return
+    seconds = time.perf_counter() - start
+
+    d_calls = dict()
+    for stub_name, stub in d_stubs.items():
+        calls = diff_counters(d_before[stub_name], stub.get_counters())
+        if calls:
+            d_calls[stub_name] = calls
+    report['stages'].append({
+        'stage': name,
+        'seconds': round(seconds, 4),
+        'rows': n_rows,
+        'rows_per_second': round(n_rows / seconds, 1) if n_rows and seconds > 0 else None,
+        'peak_mb': round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2) if trace_memory else None,
+        'calls': d_calls
+    })
+
+
+def run_scale(args, n):
+    """Runs the benchmark of n listings in the current process (caches are in a new temporary directory)."""
+    workdir = tempfile.mkdtemp(prefix='craig_bench_')
+    os.makedirs(os.path.join(workdir, 'cache'))
+    shutil.copy(os.path.join(ROOT, 'cities.json'), workdir)
+    os.chdir(workdir)
+
+    l_listings = generate_listings(n, seed=args.seed)
+    n_crawled = min(n, args.crawl_max)
+    d_stubs = {
+        'craigslist': CraigslistStub(l_listings[:n_crawled], latency=args.latency, error_rate=args.error_rate),
+        'distance_matrix': DistanceMatrixStub(latency=args.latency, error_rate=args.error_rate),
+        'sendgrid': SendGridStub(latency=args.latency, error_rate=args.error_rate),
+        'firebase': FirebaseStub(latency=args.latency, error_rate=args.error_rate)
+    }
+    for stub in d_stubs.values():
+        stub.start()
+
+    # craigslist is reached through the stub as a proxy (its urls are http), other services directly
+    os.environ['HTTP_PROXY'] = os.environ['http_proxy'] = d_stubs['craigslist'].url
+    os.environ['NO_PROXY'] = os.environ['no_proxy'] = '127.0.0.1,localhost'
+    os.environ['DISTANCE_MATRIX_URL'] = d_stubs['distance_matrix'].api_url
+    os.environ['FIREBASE_DATABASE_EMULATOR_HOST'] = d_stubs['firebase'].url[len('http://'):]
+
+    # settings read when the modules below are imported
+    import constants
+    constants.DETAIL_FETCH['delay'] = args.detail_delay
+    constants.TRAVEL_RATE_LIMIT.update({'rate': args.travel_rate, 'burst': max(1, args.travel_rate)})
+    from base import HousingCrawler
+    # modules set the root logger to DEBUG when imported
+    logging.disable(logging.INFO)
+
+    report = {'n_listings': n, 'n_crawled': n_crawled, 'stages': []}
+    if not args.no_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    hc = HousingCrawler(filters=FILTERS, destination=DESTINATION, mode=MODES, limit=n_crawled, posted_today=False,
+                        lazy=args.lazy)
+
+    def pull_data():
+        hc.pull_data()
+        return len(hc.res)
+    run_stage(report, 'pull_data', pull_data, d_stubs, not args.no_memory)
+    # listings above crawl_max are added as if they had been crawled
+    hc.res = hc.res + [to_record(listing) for listing in l_listings[n_crawled:]]
+
+    def format_data():
+        hc.format_data()
+        return len(hc.df_res)
+    run_stage(report, 'format_data', format_data, d_stubs, not args.no_memory)
+
+    if args.lazy:
+        # travel data is pulled by the score stage
+        hc.set_destinations_modes()
+    else:
+        def enrich_traveldata():
+            hc.enrich_traveldata()
+            return len(hc.df_res)
+        run_stage(report, 'enrich_traveldata', enrich_traveldata, d_stubs, not args.no_memory)
+
+    def score():
+        hc.score_lazy() if args.lazy else hc.score()
+        return len(hc.df_res)
+    run_stage(report, 'score_lazy' if args.lazy else 'score', score, d_stubs, not args.no_memory)
+
+    def sink_firebase():
+        import firebase_admin
+        from firebase_data_service import FirebaseDataService
+        if len(firebase_admin._apps) == 0:
+            firebase_admin.initialize_app(options={'databaseURL': 'https://benchmark.firebaseio.com'})
+        fb = FirebaseDataService(firebasekey_path=None)
+        fb.push_df(db_name='benchmark', df=hc.df_res, key_column='id')
+        return len(hc.df_res)
+    run_stage(report, 'sink_firebase', sink_firebase, d_stubs, not args.no_memory)
+
+    def sink_postgres_copy():
+        from utils.data_utils import copy_df
+        cursor = NullCursor()
+        copy_df(cursor, hc.df_res, 'results')
+        report['postgres_copy_bytes'] = cursor.n_bytes
+        return len(hc.df_res)
+    run_stage(report, 'sink_postgres_copy', sink_postgres_copy, d_stubs, not args.no_memory)
+
+    def sink_mail():
+        import credentials
+        # the stub does not check the key
+        if not hasattr(credentials, 'SENDGRID_API_KEY'):
+            credentials.SENDGRID_API_KEY = 'benchmark'
+        from mail_service import MailService
+        mail = MailService(sender_email='sender@example.com', receiver_email='receiver@example.com',
+                           cc=['cc@example.com'], host=d_stubs['sendgrid'].url)
+        df_mail = hc.df_res[hc.df_res.score > 0]
+        mail.create_and_send_all_msg(d_listings={0: {'title': FILTERS['title'], 'links': df_mail.url.tolist(), 'df': df_mail}})
+        return len(df_mail)
+    run_stage(report, 'sink_mail', sink_mail, d_stubs, not args.no_memory)
+
+    report['total_seconds'] = round(time.perf_counter() - start, 4)
+    if not args.no_memory:
+        report['peak_mb'] = round(max([s.get('peak_mb') or 0 for s in report['stages']]), 2)
+        tracemalloc.stop()
+    report['api_calls'] = {stub_name: stub.get_counters() for stub_name, stub in d_stubs.items()}
+
+    for stub in d_stubs.values():
+        stub.stop()
+    os.chdir(ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def print_report(l_reports):
+    header = '{:>8} {:<20} {:>10} {:>8} {:>12} {:>10}  {}'.format(
+        'listings', 'stage', 'seconds', 'rows', 'rows/s', 'peak MB', 'calls')
+    print(header)
+    print('-' * len(header))
+    for report in l_reports:
+        if 'error' in report:
+            print('{:>8} {}'.format(report['n_listings'], report['error']))
+            continue
+        for stage in report['stages']:
+            if 'skipped' in stage or 'failed' in stage:
+                status = 'skipped' if 'skipped' in stage else 'failed'
+                print('{:>8} {:<20} {} ({})'.format(report['n_listings'], stage['stage'], status, stage[status]))
+                continue
+            print('{:>8} {:<20} {:>10.3f} {:>8} {:>12} {:>10}  {}'.format(
+                report['n_listings'], stage['stage'], stage['seconds'], stage['rows'],
+                stage['rows_per_second'] or '-', stage['peak_mb'] if stage['peak_mb'] is not None else '-',
+                json.dumps(stage['calls'], sort_keys=True)))
+        print('{:>8} {:<20} {:>10.3f}'.format(report['n_listings'], 'total', report['total_seconds']))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child is not None:
+        report = run_scale(args, args.child)
+        with open(args.result, 'w') as f:
+            json.dump(report, f)
+        return
+
+    # each scale runs in a new process so that caches and memory do not carry over
+    argv = list(argv if argv is not None else sys.argv[1:])
+    l_reports = []
+    for n in args.scales:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            path_result = f.name
+        cmd = [sys.executable, '-m', 'benchmarks.run_benchmarks'] + argv + ['--child', str(n), '--result', path_result]
+        process = subprocess.run(cmd, cwd=ROOT)
+        if process.returncode == 0:
+            with open(path_result) as f:
+                l_reports.append(json.load(f))
+        else:
+            l_reports.append({'n_listings': n, 'error': 'benchmark failed (exit code {})'.format(process.returncode)})
+        os.remove(path_result)
+
+    print_report(l_reports)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(l_reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+import json
+import time
+import random
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.geo_utils import haversine
+
+# speed (metres per second) of each mode of the stub Distance Matrix API
+MODE_SPEEDS = {
+    'walking': 1.4,
+    'bicycling': 4.5,
+    'transit': 6.,
+    'driving': 11.
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else b''
+        status, headers, content = self.server.stub.dispatch(self.command, self.path, self.headers, body)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(object):
+    def __init__(self, latency=0., error_rate=0., seed=0):
+        """
+        Local HTTP server standing in for an external service, run in a background thread.
+
+        :params latency: delay (seconds) added to each response
+        :params error_rate: probability that a request gets the error response of the service
+        :params seed: seed of the random generator of errors
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = dict()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def get_counters(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def is_error(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def dispatch(self, method, path, headers, body):
+        """Returns the (status, headers, content) of a request, after latency."""
+        if self.latency > 0:
+            time.sleep(self.latency)
+        url = urlparse(path)
+        # requests sent through the server as a proxy have absolute urls
+        host = url.netloc or headers.get('Host', '')
+        status, res_headers, content = self.handle(method, host, url.path, parse_qs(url.query), body)
+        content = content.encode() if isinstance(content, str) else content
+        self.count('n_requests')
+        self.count('n_bytes', len(content) + len(body))
+        if status >= 400:
+            self.count('n_errors')
+        return status, res_headers, content
+
+    def handle(self, method, host, path, params, body):
+        """Returns the (status, headers, content) of a request (implemented by each service)."""
+        raise NotImplementedError
+
+
+class CraigslistStub(StubServer):
+    ROWS_PER_PAGE = 100
+
+    def __init__(self, l_listings, site='sfbay', area='sfc', **kwds):
+        """
+        Stand-in for craigslist (list of sites, search pages and listing pages) used as an http proxy:
+        requests to http://*.craigslist.org are sent to it through the HTTP_PROXY environment variable.
+        Errors (503) are only returned for listing pages.
+
+        :params l_listings: list of synthetic listings (see synthetic.generate_listings)
+        :params site: site code of the listings
+        :params area: area code of the listings
+        """
+        super(CraigslistStub, self).__init__(**kwds)
+        self.site = site
+        self.area = area
+        self.d_listings = {listing['id']: listing for listing in l_listings}
+        self.l_listings = sorted(l_listings, key=lambda listing: listing['datetime'], reverse=True)
+        self._d_searches = dict()
+
+    def handle(self, method, host, path, params, body):
+        html = {'Content-Type': 'text/html'}
+        if path == '/about/sites':
+            self.count('n_sites')
+            return 200, html, self.sites_page()
+        if path in ('', '/'):
+            self.count('n_base')
+            return 200, html, self.base_page()
+        if path.startswith('/search/'):
+            self.count('n_search')
+            return 200, html, self.search_page(params)
+        if path.endswith('.html'):
+            self.count('n_detail')
+            if self.is_error():
+                return 503, html, 'unavailable'
+            listing = self.d_listings.get(path.rsplit('/', 1)[-1][:-len('.html')])
+            if listing is None:
+                return 404, html, 'not found'
+            return 200, html, self.detail_page(listing)
+        return 404, html, 'not found'
+
+    def sites_page(self):
+        return '<div class="colmask"><div class="box"><h4>California</h4><ul>' \
+            '<li><a href="https://{site}.craigslist.org/">sf bay area</a></li></ul></div></div>'.format(site=self.site)
+
+    def base_page(self):
+        return '<ul class="sublinks"><li><a href="/{area}/" title="city of san francisco">{area}</a></li></ul>'.format(
+            area=self.area)
+
+    def get_matching(self, params):
+        """Returns the listings matching the filters of a search (computed once per search)."""
+        key = json.dumps({k: v for k, v in params.items() if k != 's'}, sort_keys=True)
+        with self._lock:
+            if key not in self._d_searches:
+                def bound(name, default):
+                    return float(params[name][0]) if name in params else default
+                self._d_searches[key] = [
+                    listing for listing in self.l_listings
+                    if bound('min_price', 0) <= listing['price'] <= bound('max_price', float('inf'))
+                    and bound('min_bedrooms', 0) <= listing['bedrooms'] <= bound('max_bedrooms', float('inf'))
+                    and listing['area'] >= bound('minSqft', 0)
+                ]
+            return self._d_searches[key]
+
+    def search_page(self, params):
+        l_matching = self.get_matching(params)
+        start = int(params.get('s', ['0'])[0])
+        rows = []
+        for listing in l_matching[start:start + self.ROWS_PER_PAGE]:
+            rows.append(
+                '<li class="result-row" data-pid="{id}"><p class="result-info">'
+                '<time class="result-date" datetime="{datetime}">{datetime}</time>'
+                '<a href="/{area}/apa/d/{id}.html" class="result-title hdrlnk">{name}</a>'
+                '<span class="result-meta"><span class="result-price">${price}</span>'
+                '<span class="housing">{bedrooms}br - {sqft}ft2 -</span></span></p></li>'.format(
+                    area=self.area, sqft=listing['area'], **{k: v for k, v in listing.items() if k != 'area'})
+                )
+        return '<html><body><span class="totalcount">{total}</span><ul class="rows">{rows}</ul></body></html>'.format(
+            total=len(l_matching), rows=''.join(rows))
+
+    def detail_page(self, listing):
+        return '<html><body><div id="map" data-latitude="{lat}" data-longitude="{lng}"></div>' \
+            '<section id="postingbody">{body}</section>' \
+            '<div class="postinginfos"><p class="postinginfo">posted: <time datetime="{created}:00-0700">x</time></p></div>' \
+            '<p class="attrgroup"><span><b>{bedrooms}BR</b> / <b>{bathrooms}Ba</b></span><span><b>{sqft}</b>ft2</span></p>' \
+            '</body></html>'.format(created=listing['datetime'].replace(' ', 'T'), sqft=listing['area'],
+                                     **{k: v for k, v in listing.items() if k != 'area'})
+
+
+class DistanceMatrixStub(StubServer):
+    PATH = '/maps/api/distancematrix/json'
+
+    def __init__(self, **kwds):
+        """
+        Stand-in for the Distance Matrix API: durations are the straight line distance at the speed of the mode.
+        Errors are OVER_QUERY_LIMIT responses.
+        """
+        super(DistanceMatrixStub, self).__init__(**kwds)
+
+    @property
+    def api_url(self):
+        return self.url + self.PATH
+
+    @staticmethod
+    def parse_points(value):
+        return [tuple(float(x) for x in point.split(',')) for point in value.split('|')]
+
+    def handle(self, method, host, path, params, body):
+        headers = {'Content-Type': 'application/json'}
+        if path != self.PATH:
+            return 404, headers, '{}'
+        if self.is_error():
+            self.count('n_over_query_limit')
+            return 200, headers, json.dumps({'status': 'OVER_QUERY_LIMIT', 'rows': []})
+
+        l_origins = self.parse_points(params['origins'][0])
+        l_destinations = self.parse_points(params['destinations'][0])
+        speed = MODE_SPEEDS.get(params.get('mode', ['driving'])[0], MODE_SPEEDS['driving'])
+        rows = []
+        for lat, lng in l_origins:
+            elements = []
+            for dest_lat, dest_lng in l_destinations:
+                meters = float(haversine(lat, lng, dest_lat, dest_lng))
+                elements.append({
+                    'status': 'OK',
+                    'distance': {'value': int(meters)},
+                    'duration': {'value': int(meters / speed)}
+                })
+            rows.append({'elements': elements})
+        self.count('n_elements', len(l_origins) * len(l_destinations))
+        return 200, headers, json.dumps({'status': 'OK', 'rows': rows})
+
+
+class SendGridStub(StubServer):
+    def __init__(self, **kwds):
+        """Stand-in for the SendGrid mail send API. Errors are 503 responses."""
+        super(SendGridStub, self).__init__(**kwds)
+
+    def handle(self, method, host, path, params, body):
+        if self.is_error():
+            return 503, {}, ''
+        if method == 'POST' and path == '/v3/mail/send':
+            self.count('n_personalizations', len(json.loads(body).get('personalizations', [])))
+            return 202, {}, ''
+        return 404, {}, ''
+
+
+class FirebaseStub(StubServer):
+    def __init__(self, **kwds):
+        """
+        Stand-in for the Firebase Realtime Database REST API (the emulator protocol of firebase_admin,
+        see FIREBASE_DATABASE_EMULATOR_HOST). Errors are 503 responses.
+        """
+        super(FirebaseStub, self).__init__(**kwds)
+
+    def handle(self, method, host, path, params, body):
+        headers = {'Content-Type': 'application/json'}
+        if self.is_error():
+            return 503, headers, '{"error": "unavailable"}'
+        if method in ('PATCH', 'PUT'):
+            self.count('n_records', len(json.loads(body)))
+            return 200, headers, body
+        return 200, headers, 'null'
@@ -0,0 +1,62 @@
+import datetime
+
+import numpy as np
+
+# listings are drawn around San Francisco (site sfbay, area sfc)
+CENTER = (37.7749, -122.4194)
+WORDS = ['sunny', 'spacious', 'quiet', 'renovated', 'kitchen', 'laundry', 'parking', 'close', 'park', 'views',
+         'hardwood', 'floors', 'bright', 'modern', 'walk', 'transit', 'shops', 'cafes', 'deck', 'garden']
+
+
+def generate_listings(n, seed=0, center=CENTER, radius=0.05):
+    """
+    Generates synthetic listings.
+
+    :params n: number of listings
+    :params seed: seed of the random generator (same seed, same listings)
+    :params center: tuple (lat, lng) around which listings are drawn
+    :params radius: maximum offset (degrees) of the coordinates of listings from center
+
+    :output l_listings: list of dicts with keys id, name, price, bedrooms, bathrooms, area, lat, lng, datetime, body
+    """
+    rng = np.random.default_rng(seed)
+    bedrooms = rng.integers(0, 4, n)
+    area = (350 + 300 * bedrooms + rng.normal(0, 120, n)).clip(200).astype(int)
+    price = (area * rng.uniform(3, 8, n)).round(-1).astype(int)
+    lat = center[0] + rng.uniform(-radius, radius, n)
+    lng = center[1] + rng.uniform(-radius, radius, n)
+    minutes = rng.integers(0, 24 * 60, n)
+    start = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    words = np.array(WORDS)[rng.integers(0, len(WORDS), (n, 40))]
+
+    l_listings = []
+    for i in range(n):
+        l_listings.append({
+            'id': str(7000000000 + i),
+            'name': '{} br apartment'.format(bedrooms[i]),
+            'price': int(price[i]),
+            'bedrooms': int(bedrooms[i]),
+            'bathrooms': 1 + int(bedrooms[i] > 1),
+            'area': int(area[i]),
+            'lat': round(float(lat[i]), 6),
+            'lng': round(float(lng[i]), 6),
+            'datetime': (start + datetime.timedelta(minutes=int(minutes[i]))).strftime('%Y-%m-%d %H:%M'),
+            'body': ' '.join(words[i])
+        })
+    return l_listings
+
+def to_record(listing, base_url='https://sfbay.craigslist.org/sfc/apa/d/'):
+    """Converts a synthetic listing into a record as returned by the crawl (see HousingCrawler.pull_data)."""
+    return {
+        'id': listing['id'],
+        'url': '{}{}.html'.format(base_url, listing['id']),
+        'datetime': listing['datetime'],
+        'created': listing['datetime'],
+        'last_updated': listing['datetime'],
+        'geotag': (listing['lat'], listing['lng']),
+        'price': '${}'.format(listing['price']),
+        'area': '{}ft2'.format(listing['area']),
+        'bedrooms': str(listing['bedrooms']),
+        'bathrooms': str(listing['bathrooms']),
+        'body': listing['body']
+    }
@@ -1,3 +1,5 @@
+import os
+
 STYLE = """
 <style type="text/css">
       .dataframe {
@@ -53,6 +55,12 @@ MSG_LINKS = """
 </p>
 """
 
+# sendgrid dispatch: personalizations per message, concurrent sends and retries (backoff in seconds)
+MAIL_MAX_PERSONALIZATIONS = 1000
+MAIL_MAX_WORKERS = 4
+MAIL_RETRIES = 3
+MAIL_BACKOFF = 1
+
 MAIL_COLUMNS = ['url', 'price', 'area', 'score', 'travel_Uber_score', 'travel_Dropbox_score', 'ppsqft_score']
 
 d_COLUMNS = {'results' : ['id', 'url', 'datetime', 'created', 'last_updated', 'price', 'area',
@@ -68,6 +76,121 @@ d_COLUMNS = {'results' : ['id', 'url', 'datetime', 'created', 'last_updated', 'p
        'travel_Dropbox_score', 'score', 'datestr']}
 
 CACHE_DIR = 'cache/'
+# listings: format of crawled timestamps and scale of the integer keys of coordinates
+# (lat_key = rint(lat * LATLNG_KEY_SCALE), i.e. rounded to 4 decimals or about 10m, listings sharing keys share travel data)
+DATETIME_FORMAT = '%Y-%m-%d %H:%M'
+LATLNG_KEY_SCALE = 10000
+# maximum number of entries of each function cache (least recently used entries are evicted)
+CACHE_MAX_ENTRIES = 100000
+
+# incremental crawls: index of listings already crawled and number of consecutive known listings to stop at
+SEEN_LISTINGS_PATH = CACHE_DIR + 'seen_listings.sqlite'
+INCREMENTAL_STOP_AFTER = 5
+# concurrent fetches of listing pages: total and per host, delay (seconds) between requests to a host and retries
+DETAIL_FETCH = {
+  'max_workers': 8,
+  'per_host': 4,
+  'delay': 0.25,
+  'retries': 3,
+  'backoff': 1
+}
+# maximum number of listings whose details are shared between the crawls of a process (see SHARED_DETAILS)
+SHARED_DETAILS_MAX = 10000
+# firebase pushes: maximum size (bytes) of a multi-path update and index of the hashes of pushed records
+FIREBASE_BATCH_BYTES = 1000000
+FIREBASE_HASHES_PATH = CACHE_DIR + 'firebase_hashes.sqlite'
+# hashes of pushed listings expire with the listings (craigslist housing posts expire after 30 to 45 days)
+FIREBASE_HASHES_TTL = 45
+FIREBASE_HASHES_MAX = 100000
+# postgres connection pool and number of rows converted to csv at once by COPY
+POSTGRES_POOL = {
+  'minconn': 1,
+  'maxconn': 4
+}
+COPY_CHUNK_ROWS = 10000
+# number of listings per chunk when crawling and enriching are streamed
+STREAM_CHUNK_SIZE = 25
+
+# craigslist cities crawl (scripts/get_cities.py): list of sites, output, checkpoint to resume and
+# concurrent fetches with a per host and a global rate limit
+LINK_CITIES = 'https://www.craigslist.org/about/sites'
+PATH_CITIES = 'cities.json'
+CITIES_CRAWL = {
+  'checkpoint_path': CACHE_DIR + 'cities_checkpoint.json',
+  'max_workers': 8,
+  # requests per second to a host and to all hosts (420 cities in about 2 minutes)
+  'rate': 0.5,
+  'max_rate': 4,
+  'save_every': 20
+}
+# compiled index of craigslist sites and areas (rebuilt when PATH_CITIES is newer)
+SITE_INDEX_PATH = CACHE_DIR + 'site_index.pickle'
+
+# run metrics: json report, Prometheus textfile (read by the textfile collector of the node exporter) and profiles
+METRICS_DIR = 'metrics/'
+METRICS_REPORT_PATH = METRICS_DIR + 'run_report.json'
+METRICS_PROM_PATH = os.environ.get('CRAIG_PROM_TEXTFILE', METRICS_DIR + 'craig.prom')
+
+# keep-alive http session shared by all outbound calls (timeout is (connect, read) in seconds)
+HTTP_POOL = {
+  'pool_connections': 10,
+  'pool_maxsize': 20,
+  'retries': 3,
+  'backoff_factor': 1,
+  'timeout': (5, 30)
+}
+
+# Distance Matrix API (the url can be overridden, e.g. to point at the stub server of the benchmarks)
+# and its limits for a single request
+DISTANCE_MATRIX_URL = os.environ.get('DISTANCE_MATRIX_URL', "https://maps.googleapis.com/maps/api/distancematrix/json")
+DISTANCE_MATRIX_MAX_ORIGINS = 25
+DISTANCE_MATRIX_MAX_DESTINATIONS = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+
+# rate limit of the travel API (requests per second and burst), shared between processes through state_path
+TRAVEL_RATE_LIMIT = {
+  'rate': 10,
+  'burst': 10,
+  'state_path': CACHE_DIR + 'travel_rate_limit.json'
+}
+# number of attempts when the travel API asks to slow down and backoff (seconds) if no Retry-After is given
+TRAVEL_MAX_ATTEMPTS = 5
+TRAVEL_BACKOFF = 2
+# maximum number of concurrent requests to the travel API
+TRAVEL_MAX_WORKERS = 8
+# persistent travel-time store: results of origins within tolerance (metres) are reused for ttl (days)
+TRAVEL_STORE_PARAMS = {
+  'path': CACHE_DIR + 'travel_store.sqlite',
+  'tolerance': 50,
+  'ttl': 30
+}
+# local travel time estimator: maximum speeds (metres per second) of modes when there are not enough stored results
+# to calibrate them, margin applied to calibrated speeds and minimum number of stored results to calibrate a mode
+TRAVEL_MAX_SPEEDS = {
+  'walking': 2.5,
+  'bicycling': 10,
+  'transit': 30,
+  'driving': 40
+}
+TRAVEL_ESTIMATE = {
+  'margin': 1.25,
+  'min_samples': 100
+}
+# isochrone grids: travel times precomputed over a grid of each crawl area (see scripts/build_isochrones.py).
+# bounding boxes [lat_min, lng_min, lat_max, lng_max] of crawl areas, step (metres) of grids, age (days) after which
+# grids are not used and accuracy (minutes): durations are interpolated when the grid cell varies by less than accuracy
+# and is at least accuracy away from the bounds of SCORE_BOUNDS (otherwise they are looked up)
+ISOCHRONE_DIR = CACHE_DIR + 'isochrones/'
+AREA_BBOXES = {
+  'sfbay': {
+    'sfc': [37.70, -122.52, 37.82, -122.35]
+  }
+}
+ISOCHRONE_PARAMS = {
+  'step': 250,
+  'ttl': 30,
+  'accuracy': 2
+}
 
 SCORE_BOUNDS = {
   'ppsqft': {
@@ -1,14 +1,32 @@
+import json
+import logging
+import hashlib
 import datetime
 
+import numpy as np
 import firebase_admin
 from firebase_admin import credentials, db
 from credentials import DB_URL
 
+from constants import FIREBASE_BATCH_BYTES, FIREBASE_HASHES_PATH, FIREBASE_HASHES_TTL, FIREBASE_HASHES_MAX, DATETIME_FORMAT
+from utils.cache_utils import SQLiteCache
+from utils.http_utils import count_requests
+
 
 class FirebaseDataService(object):
-	def __init__(self, firebasekey_path):
+	def __init__(self, firebasekey_path, hashes_path=FIREBASE_HASHES_PATH):
+		"""
+		:param firebasekey_path: path of the firebase key
+		:param hashes_path: path of the local index of the hashes of pushed records
+		"""
 		self.firebasekey_path = firebasekey_path
 		self.default_app = None
+		# content hash of the records already pushed (by db_name/id), expiring with listings
+		self.hashes = SQLiteCache(
+			path=hashes_path,
+			stale_after=datetime.timedelta(days=FIREBASE_HASHES_TTL),
+			max_entries=FIREBASE_HASHES_MAX
+			)
 		if len(firebase_admin._apps) == 0:
 			self.connect()
 
@@ -43,3 +61,93 @@ class FirebaseDataService(object):
 			df['db_key'] = df[key_column].astype(str)
 		dict_res =  df.set_index('db_key').T.to_dict()
 		return dict_res
+
+	def format_records(self, df, key_column='key', add_date=True):
+		"""
+		Same as format_df without transposing df (and without adding columns to df).
+		Missing values are None, timestamps are formatted with DATETIME_FORMAT and float32 columns are rounded floats.
+		The keys of the rounded coordinates (lat_key, lng_key) are only used for lookups and are not pushed.
+		:param df: pd DataFrame 
+		:param key_column: the name of the column that should represent the key
+		:param add_date: add date if True to key 
+		"""
+		datestr = datetime.datetime.today().strftime('%Y%m%d')
+		# the databse key is the keycolumn (+ date)
+		l_keys = df[key_column].astype(str)
+		if add_date:
+			l_keys = datestr + l_keys
+		df = df.drop([col for col in ['lat_key', 'lng_key'] if col in df.columns], axis=1)
+		# json friendly values
+		d_columns = {col: df[col].dt.strftime(DATETIME_FORMAT) for col in df.select_dtypes('datetime').columns}
+		d_columns.update({col: df[col].astype(np.float64).round(6) for col in df.select_dtypes(np.float32).columns})
+		l_records = df.assign(datestr=datestr, **d_columns).replace({np.nan: None}).to_dict('records')
+		dict_res = dict(zip(l_keys.tolist(), l_records))
+		return dict_res
+
+	@staticmethod
+	def hash_record(record):
+		"""Returns the hash of the content of a record (without the date of the push)."""
+		content = {key: value for key, value in record.items() if key != 'datestr'}
+		return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+	def push_data(self, db_name, data, max_bytes=FIREBASE_BATCH_BYTES, key_column=None):
+		"""
+		Pushes the records whose content changed since the last push, with multi-path updates of at most max_bytes.
+		:param db_name: name of the database
+		:param data: dict of records (see format_records)
+		:param max_bytes: maximum size of the json of an update
+		:param key_column: column identifying a listing across pushes (the keys of data if None, they change every day
+		when they include the date)
+		"""
+		ref = db.reference(db_name)
+		# skip records that did not change since the last push 
+		d_hashes = dict()
+		d_index_keys = dict()
+		for key, record in data.items():
+			hash_ = self.hash_record(record)
+			d_index_keys[key] = '/'.join([db_name, str(record[key_column]) if key_column is not None else key])
+			hit, hash_pushed = self.hashes.get(d_index_keys[key])
+			if not hit or hash_pushed != hash_:
+				d_hashes[key] = hash_
+
+		batch = dict()
+		batch_bytes = 0
+		n_batches = 0
+		for key in d_hashes.keys():
+			record_bytes = len(json.dumps(data[key], default=str)) + len(key)
+			if len(batch) > 0 and batch_bytes + record_bytes > max_bytes:
+				self._push_batch(ref, batch, d_hashes, d_index_keys)
+				n_batches += 1
+				batch, batch_bytes = dict(), 0
+			batch[key] = data[key]
+			batch_bytes += record_bytes
+		if len(batch) > 0:
+			self._push_batch(ref, batch, d_hashes, d_index_keys)
+			n_batches += 1
+
+		logging.info({'msg': 'Pushed {n_changed} changed records out of {n_records} in {n_batches} batches'.format(
+			n_changed=len(d_hashes),
+			n_records=len(data),
+			n_batches=n_batches
+			)})
+
+	def _push_batch(self, ref, batch, d_hashes, d_index_keys):
+		"""
+		Pushes a batch of records and saves their hashes (in one transaction).
+		The request is added to the http counters (firebase_admin has its own session), bytes received are not known.
+		"""
+		n_bytes_sent = len(json.dumps(batch, default=str))
+		try:
+			ref.update(batch)
+		except Exception:
+			count_requests(n_bytes_sent=n_bytes_sent, n_errors=1)
+			raise
+		count_requests(n_bytes_sent=n_bytes_sent)
+		self.hashes.set_many([(d_index_keys[key], d_hashes[key]) for key in batch.keys()])
+
+	def push_df(self, db_name, df, key_column='key', add_date=True):
+		"""
+		Pushes the records of df whose content changed since the last push (see format_records and push_data).
+		"""
+		data = self.format_records(df, key_column=key_column, add_date=add_date)
+		self.push_data(db_name=db_name, data=data, key_column=key_column)
@@ -1,32 +1,44 @@
+import time
+import json
+import socket
 import logging 
 import smtplib
 import datetime
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from sendgrid.helpers.mail import Mail, Personalization, To
 from sendgrid.helpers.mail.cc_email import Cc 
 from credentials import SENDGRID_API_KEY
+from utils.http_utils import count_requests
 
-from constants import MSG_SHELL, MSG_LINKS, MAIL_COLUMNS, STYLE
+from constants import MSG_SHELL, MSG_LINKS, MAIL_COLUMNS, STYLE, MAIL_MAX_PERSONALIZATIONS, MAIL_MAX_WORKERS, \
+	MAIL_RETRIES, MAIL_BACKOFF
 
 logging.root.setLevel(logging.DEBUG)
 
 class MailService(object):
-	def __init__(self, sender_email, receiver_email, cc = None):
+	def __init__(self, sender_email, receiver_email, cc = None, host = None):
 		"""
 		:param sender_auth: dict with sender_email and sender password
 		:param receiver: list or str of the receiver email(s) 
 		:param cc: list of str for the emails to cc 
+		:param host: url of the SendGrid API (e.g. a local stub for tests), SendGrid's by default
 		"""
 		self.sender_email = sender_email
 		self.receiver_email = receiver_email
 		self.cc = cc
+		self.host = host
 		# mail server 
 		self.smtpserver = None
 
 	def connect(self):
 		# connect to gmail server through 587 port 
-		smtpserver = SendGridAPIClient(SENDGRID_API_KEY)
+		if self.host is not None:
+			smtpserver = SendGridAPIClient(SENDGRID_API_KEY, host=self.host)
+		else:
+			smtpserver = SendGridAPIClient(SENDGRID_API_KEY)
 
 		self.smtpserver = smtpserver
 		logging.info({'msg': 'Connection Established'})
@@ -44,18 +56,70 @@ class MailService(object):
 		l_msg = list(m_msg)
 		return l_msg
 
-	def send_all_msg(self, l_msg):
+	def create_personalized_msgs(self, msg_text, l_receivers, max_personalizations=MAIL_MAX_PERSONALIZATIONS):
 		"""
-		Sends list of messages at once.
+		Creates as few messages as possible to send msg_text to all receivers, each receiver in its own personalization
+		(receivers don't see each other). The html is shared by all personalizations.
+
+		:param msg_text: html of the message
+		:param l_receivers: list of str of the receivers emails
+		:param max_personalizations: maximum number of personalizations per message (1000 for SendGrid)
+		"""
+		today_date = datetime.date.today().strftime("%Y-%m-%d")
+		l_msg = []
+		for i in range(0, len(l_receivers), max_personalizations):
+			msg = Mail(
+				from_email= self.sender_email,
+				subject= 'Listings for {}'.format(today_date),
+				html_content=msg_text
+				)
+			for receiver in l_receivers[i:i + max_personalizations]:
+				personalization = Personalization()
+				personalization.add_to(To(receiver))
+				msg.add_personalization(personalization)
+			l_msg.append(msg)
+		return l_msg
+
+	def send_all_msg(self, l_msg, max_workers=MAIL_MAX_WORKERS):
+		"""
+		Sends list of messages at once (concurrently).
 		"""
 		l_msg = [l_msg] if not isinstance(l_msg, list) else l_msg
-		for msg in l_msg:
-			self.send_msg(msg)
+		if self.smtpserver is None:
+			self.connect()
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			# raise the first error, if any
+			list(executor.map(self.send_msg_with_retry, l_msg))
+
+	@staticmethod
+	def is_retryable(error):
+		"""Returns True if sending may succeed later: 429 and 5xx responses, connection errors and timeouts."""
+		status_code = getattr(error, 'status_code', None)
+		if status_code is None and isinstance(error, urllib.error.HTTPError):
+			status_code = error.code
+		if status_code is not None:
+			return status_code == 429 or status_code >= 500
+		return isinstance(error, (urllib.error.URLError, ConnectionError, TimeoutError, socket.timeout))
+
+	def send_msg_with_retry(self, msg, retries=MAIL_RETRIES, backoff=MAIL_BACKOFF):
+		"""
+		Sends msg, retrying with exponential backoff if sending fails with a retryable error (see is_retryable).
+		"""
+		for attempt in range(retries + 1):
+			try:
+				return self.send_msg(msg)
+			except Exception as e:
+				if attempt == retries or not self.is_retryable(e):
+					raise
+				count_requests(n_requests=0, n_retries=1)
+				logging.warning({'msg': 'sending email failed: {}'.format(e), 'attempt': attempt + 1})
+				time.sleep(backoff * 2 ** attempt)
 
 
 	def send_msg(self, msg):
 		"""
 		Sends email to sender, receiverspecified in msg object
+		The request is added to the http counters (SendGrid has its own client).
 
 		:param msg: email.message.Message cls 
 		"""
@@ -63,8 +127,13 @@ class MailService(object):
 			self.connect()
 
 		# send email 
-
-		self.smtpserver.send(msg)
+		n_bytes_sent = len(json.dumps(msg.get()))
+		try:
+			response = self.smtpserver.send(msg)
+		except Exception:
+			count_requests(n_bytes_sent=n_bytes_sent, n_errors=1)
+			raise
+		count_requests(n_bytes=len(response.body or b''), n_bytes_sent=n_bytes_sent)
 
 		logging.info(
 			{
@@ -75,12 +144,21 @@ class MailService(object):
 			}
 			)
 
-	def create_and_send_all_msg(self, d_listings):
+	def create_and_send_all_msg(self, d_listings, personalize=False):
 		"""
 		Writes and sends all messages to all recipients
+
+		:param d_listings: dict of listings by category (see write_msg)
+		:param personalize: send to each receiver (and cc) separately through personalizations
 		"""
-		# write message 
+		# write message (once for all recipients)
 		msg_text = self.write_msg(d_listings)
+		if personalize:
+			l_receivers = self.receiver_email if isinstance(self.receiver_email, list) else [self.receiver_email]
+			l_cc = self.cc if isinstance(self.cc, list) else [self.cc] if self.cc is not None else []
+			l_msg = self.create_personalized_msgs(msg_text, l_receivers + l_cc)
+			self.send_all_msg(l_msg)
+			return
 		# create message class
 		# make the first email main received and the rest None 
 		msg = self.create_msg_cls(
@@ -133,11 +211,9 @@ class MailService(object):
 		"""
 		assert all([i in df.columns for i in cols]), 'all cols must be in df columns'
 
-		# convert url to hyperlink
-		df['url'] =  df[['url', 'id']].apply(lambda x: "<a href={}>{}</a>".format(x.url, x.id), axis = 1)
-
-		# select columns of interest
-		temp = df[cols]
+		# select columns of interest and convert url to hyperlink
+		links = "<a href=" + df['url'].astype(str) + ">" + df['id'].astype(str) + "</a>"
+		temp = df[cols].assign(url=links)
 
 		# convert to html
 		html_table = temp.to_html(render_links=True, escape=False)
@@ -4,9 +4,25 @@ from base import HousingCrawler
 from mail_service import MailService
 from firebase_data_service import FirebaseDataService 
 from credentials import SENDER_EMAIL, DB_NAME, FIREBASE_KEY_PATH
+from constants import METRICS_REPORT_PATH, METRICS_PROM_PATH
+from utils.plan_utils import plan_crawls
+from utils.metrics_utils import RunMetrics
 
 
-def main(limit=None):
+def main(limit=None, profile_stage=None):
+	"""
+	:param limit: maximum number of listings crawled per filter
+	:param profile_stage: name of the stage to profile with cProfile (e.g. enrich_traveldata)
+	"""
+	# measures of all stages and sinks, written at the end of the run (even if it fails)
+	metrics = RunMetrics(caches=HousingCrawler.get_metric_caches(), profile_stage=profile_stage)
+	try:
+		run(metrics, limit=limit)
+	finally:
+		metrics.write_json(METRICS_REPORT_PATH)
+		metrics.write_prometheus(METRICS_PROM_PATH)
+
+def run(metrics, limit=None):
 	# get input data 
 	with open("/home/zakariaelhjouji/craig/input.json", "r") as f:
 		input_ = json.load(f)
@@ -19,34 +35,47 @@ def main(limit=None):
 	# create dictionary for all listings to be sent by mail 
 	d_listings = dict()
 
-	for i, filter_ in enumerate(all_filters):
-		# create dict of listings for filter_ 
-		d_links = dict()
-		hc = HousingCrawler(
-		    filters=filter_, 
+	# firebase sink shared by all filters
+	fb = FirebaseDataService(FIREBASE_KEY_PATH) 
+	metrics.add_caches({'firebase_hashes': fb.hashes})
+
+	# crawls whose listings are marked as crawled once the run completes (incremental crawls)
+	l_hc_plans = []
+
+	# filters on the same site and area are crawled and enriched once
+	for plan in plan_crawls(all_filters):
+		hc_plan = HousingCrawler(
+		    filters=plan['filters'], 
 		    destination=destination,
 		    mode=mode,
-		    limit=limit
+		    limit=limit,
+		    metrics=metrics
 		    )
-		hc.run_all()
+		hc_plan.run_all(score=False, mark_seen=False)
+		l_hc_plans.append(hc_plan)
 
-		# import ipdb; ipdb.set_trace()
-		d_links['title'] = filter_.get('title')
-		d_links['links'] = hc.url_considered
-		d_links['df'] = hc.df_res[hc.df_res.score > 0].copy()
+		for i, filter_ in plan['members']:
+			# create dict of listings for filter_ 
+			d_links = dict()
+			hc = hc_plan.subset(filter_)
 
-		d_listings[i] = d_links
+			d_links['title'] = filter_.get('title')
+			d_links['links'] = hc.url_considered
+			d_links['df'] = hc.df_res[hc.df_res.score > 0]
 
-		# save data
-		fb = FirebaseDataService(FIREBASE_KEY_PATH) 
-		dict_res = fb.format_df(df=hc.df_res, key_column='id')
-		fb.update_data(db_name=DB_NAME, data=dict_res)
+			d_listings[i] = d_links
 
+			# save data (only listings that changed since the last push)
+			with metrics.stage('sink_firebase', **hc.get_metric_labels()) as record:
+				fb.push_df(db_name=DB_NAME, df=hc.df_res, key_column='id')
+				record['rows'] = hc.df_res.shape[0]
+
+	# keep the order of filters in the mail 
+	d_listings = dict(sorted(d_listings.items()))
 
 	# set the first email as main receiver and cc the rest 
-	if len(receiver) > 1:
-		receiver_email = receiver[0]
-		cc = receiver[1:]
+	receiver_email = receiver[0]
+	cc = receiver[1:] if len(receiver) > 1 else None
 
 	# call mail service and send messages 
 	mail = MailService(
@@ -55,9 +84,17 @@ def main(limit=None):
 		cc = cc
 		)
 
-	mail.create_and_send_all_msg(
-		d_listings=d_listings
-	)
+	with metrics.stage('sink_mail') as record:
+		# each receiver gets its own personalization (receivers don't see each other)
+		mail.create_and_send_all_msg(
+			d_listings=d_listings,
+			personalize=True
+		)
+		record['rows'] = sum([d_links['df'].shape[0] for d_links in d_listings.values()])
+
+	# listings were pushed and mailed
+	for hc_plan in l_hc_plans:
+		hc_plan.mark_seen()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+"""
+Builds the isochrone grids of the crawl areas of input.json: travel data from a grid over each area to each
+destination using each mode, used by HousingCrawler.enrich_traveldata to interpolate travel data of listings.
+Grids are not used after ISOCHRONE_PARAMS['ttl'] days, run it again before (or when destinations or modes change).
+
+Usage (from the root of the repo):
+	python -m scripts.build_isochrones --input input.json
+"""
+import json
+import logging
+import argparse
+
+from constants import ISOCHRONE_PARAMS
+from utils.isochrone_utils import build_isochrone_grid, get_isochrone_grid
+
+
+def main(path_input='input.json', step=ISOCHRONE_PARAMS['step'], force=False):
+	"""
+	:param path_input: path of the input (filters, destination and mode)
+	:param step: distance (metres) between two nodes of the grids
+	:param force: rebuild grids that are still valid
+	"""
+	with open(path_input, 'r') as f:
+		input_ = json.load(f)
+
+	destination = input_.get('destination')
+	mode = input_.get('mode')
+	l_modes = [mode] if isinstance(mode, str) else mode
+
+	# one grid per crawl area
+	for site, area in sorted({(filter_['site'], filter_.get('area')) for filter_ in input_.get('filters')}):
+		grid = get_isochrone_grid(site, area)
+		if not force and grid is not None and grid.covers(destination, l_modes):
+			logging.info({'msg': 'isochrone grid of {} {} is up to date'.format(site, area)})
+			continue
+		grid = build_isochrone_grid(site, area, destination, l_modes, step=step)
+		logging.info({'msg': 'built the isochrone grid of {} {}: {} x {} nodes'.format(site, area, len(grid.lat), len(grid.lng))})
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Builds the isochrone grids of the crawl areas')
+	parser.add_argument('--input', default='input.json', help='path of the input (filters, destination and mode)')
+	parser.add_argument('--step', type=float, default=ISOCHRONE_PARAMS['step'], help='distance (metres) between two nodes')
+	parser.add_argument('--force', action='store_true', help='rebuild grids that are still valid')
+	args = parser.parse_args()
+	main(path_input=args.input, step=args.step, force=args.force)
@@ -0,0 +1,40 @@
+"""
+Environment of the tests importing base (see import_base): craigslist fetches its sites when it is imported and
+the crawler opens its caches in the working directory, so both are redirected as in benchmarks/run_benchmarks.py.
+"""
+import os
+import sys
+import shutil
+import logging
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.stub_servers import CraigslistStub, DistanceMatrixStub
+
+# stub servers of the process (started on first import of base)
+_D_STUBS = dict()
+
+
+def import_base():
+    """
+    Imports and returns the module base with craigslist and the Distance Matrix API served by local stubs and the
+    caches in a new temporary working directory (the working directory stays there for the rest of the process).
+    """
+    if 'base' not in sys.modules:
+        workdir = tempfile.mkdtemp(prefix='craig_test_')
+        os.makedirs(os.path.join(workdir, 'cache'))
+        shutil.copy(os.path.join(ROOT, 'cities.json'), workdir)
+        os.chdir(workdir)
+
+        _D_STUBS['craigslist'] = CraigslistStub([]).start()
+        _D_STUBS['distance_matrix'] = DistanceMatrixStub().start()
+        os.environ['HTTP_PROXY'] = os.environ['http_proxy'] = _D_STUBS['craigslist'].url
+        os.environ['NO_PROXY'] = os.environ['no_proxy'] = '127.0.0.1,localhost'
+        os.environ['DISTANCE_MATRIX_URL'] = _D_STUBS['distance_matrix'].api_url
+    import base
+    # modules set the root logger to DEBUG when imported
+    logging.disable(logging.INFO)
+    return base
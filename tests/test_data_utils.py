@@ -0,0 +1,186 @@
+"""
+Tests of the SQL and csv generated by utils.data_utils against a mocked cursor (no database needed).
+
+Usage (from the root of the repo):
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+from contextlib import contextmanager
+from unittest import mock
+
+import pandas as pd
+from psycopg2 import sql
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from constants import d_COLUMNS
+from utils import data_utils
+
+
+def render(composable):
+    """Returns the text of a psycopg2.sql object (as_string needs a connection)."""
+    if isinstance(composable, sql.Composed):
+        return ''.join([render(part) for part in composable.seq])
+    if isinstance(composable, sql.Identifier):
+        return '.'.join(['"{}"'.format(string) for string in composable.strings])
+    if isinstance(composable, sql.SQL):
+        return composable.string
+    return composable
+
+
+class MockCursor(object):
+    """Cursor recording the statements it executes and the data sent by COPY."""
+    def __init__(self):
+        self.l_statements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, params=None):
+        self.l_statements.append((render(statement), params))
+
+    def copy_expert(self, statement, file):
+        self.l_statements.append((render(statement), file.read()))
+
+
+def make_df(n_rows=5):
+    return pd.DataFrame({
+        'id': list(range(n_rows)),
+        'url': ['https://sfbay.craigslist.org/{}.html'.format(i) for i in range(n_rows)],
+        'price': [3000 + i for i in range(n_rows)],
+        'body': ['with, comma' if i % 2 else 'with "quotes"\nand a new line' for i in range(n_rows)]
+    })
+
+
+class TestDataFrameCSV(unittest.TestCase):
+    def test_read_chunks(self):
+        df = make_df(5)
+        expected = df.to_csv(index=False, header=False)
+        for chunk_rows in [1, 2, 5, 10]:
+            for size in [-1, 1, 7, 1000]:
+                f = data_utils.DataFrameCSV(df, chunk_rows=chunk_rows)
+                chunks = []
+                chunk = f.read(size)
+                while chunk:
+                    chunks.append(chunk)
+                    chunk = f.read(size)
+                self.assertEqual(''.join(chunks), expected, (chunk_rows, size))
+
+    def test_readline(self):
+        df = make_df(4)
+        f = data_utils.DataFrameCSV(df, chunk_rows=3)
+        lines = []
+        line = f.readline()
+        while line:
+            lines.append(line)
+            line = f.readline()
+        self.assertEqual(''.join(lines), df.to_csv(index=False, header=False))
+
+    def test_empty(self):
+        self.assertEqual(data_utils.DataFrameCSV(make_df(0)).read(), '')
+
+
+class TestCopy(unittest.TestCase):
+    def test_copy_df(self):
+        df = make_df(3).rename(columns={'price': 'Price'})
+        cursor = MockCursor()
+        data_utils.copy_df(cursor, df, 'results')
+        self.assertEqual(cursor.l_statements, [(
+            'COPY "results" ("id", "url", "price", "body") FROM STDIN WITH (FORMAT csv)',
+            df.to_csv(index=False, header=False)
+        )])
+
+    def test_create_partition(self):
+        cursor = MockCursor()
+        data_utils.create_partition(cursor, 'results', '2020-05-01')
+        self.assertEqual(cursor.l_statements, [(
+            'CREATE TABLE IF NOT EXISTS "results_20200501" PARTITION OF "results" FOR VALUES IN (%s)',
+            ('2020-05-01',)
+        )])
+
+
+@contextmanager
+def mocked_pool(cursor):
+    """Replaces the connection pool of data_utils by one whose connections yield cursor."""
+    connection = mock.MagicMock()
+    connection.cursor.return_value = cursor
+    pool = mock.MagicMock()
+    pool.getconn.return_value = connection
+    with mock.patch.object(data_utils, 'get_pool', return_value=pool):
+        yield connection, pool
+
+
+class TestPush(unittest.TestCase):
+    def make_results(self, l_datestr):
+        columns = d_COLUMNS['results']
+        df = pd.DataFrame([[i] * len(columns) for i in range(len(l_datestr))], columns=columns)
+        df['datestr'] = l_datestr
+        return df
+
+    def test_push_data(self):
+        df = self.make_results(['2020-05-01'])
+        cursor = MockCursor()
+        with mocked_pool(cursor) as (connection, pool):
+            data_utils.push_data(df, auth={})
+        self.assertEqual(len(cursor.l_statements), 1)
+        statement, data = cursor.l_statements[0]
+        self.assertTrue(statement.startswith('COPY "results" ("id", "url", '))
+        self.assertIn('"distance_uber_cycling"', statement)
+        self.assertEqual(data, df.to_csv(index=False, header=False))
+        connection.commit.assert_called_once()
+        pool.putconn.assert_called_once_with(connection)
+
+    def test_upsert_data(self):
+        df = self.make_results(['2020-05-01', '2020-05-02', '2020-05-01'])
+        cursor = MockCursor()
+        with mocked_pool(cursor) as (connection, pool):
+            data_utils.upsert_data(df, auth={})
+        l_statements = [statement for statement, _ in cursor.l_statements]
+
+        # one partition per date, then staging table, copy and merge
+        self.assertEqual(cursor.l_statements[:2], [
+            ('CREATE TABLE IF NOT EXISTS "results_20200501" PARTITION OF "results" FOR VALUES IN (%s)', ('2020-05-01',)),
+            ('CREATE TABLE IF NOT EXISTS "results_20200502" PARTITION OF "results" FOR VALUES IN (%s)', ('2020-05-02',)),
+        ])
+        self.assertEqual(l_statements[2],
+                         'CREATE TEMP TABLE "results_staging" (LIKE "results" INCLUDING DEFAULTS) ON COMMIT DROP')
+        self.assertTrue(l_statements[3].startswith('COPY "results_staging" ("id", '))
+        self.assertEqual(cursor.l_statements[3][1], df.to_csv(index=False, header=False))
+
+        merge = ' '.join(l_statements[4].split())
+        columns = ', '.join(['"{}"'.format(col.lower()) for col in df.columns])
+        self.assertTrue(merge.startswith(
+            'INSERT INTO "results" ({columns}) SELECT {columns} FROM "results_staging" '
+            'ON CONFLICT ("id", "datestr") DO UPDATE SET "url" = EXCLUDED."url", '.format(columns=columns)
+        ))
+        self.assertNotIn('"id" = EXCLUDED', merge)
+        self.assertNotIn('"datestr" = EXCLUDED', merge)
+        self.assertTrue(merge.endswith('"score" = EXCLUDED."score"'))
+        connection.commit.assert_called_once()
+        connection.rollback.assert_not_called()
+
+    def test_upsert_rollback(self):
+        df = self.make_results(['2020-05-01'])
+        cursor = MockCursor()
+        cursor.copy_expert = mock.Mock(side_effect=RuntimeError('copy failed'))
+        with mocked_pool(cursor) as (connection, pool):
+            with self.assertRaises(RuntimeError):
+                data_utils.upsert_data(df, auth={})
+        connection.rollback.assert_called_once()
+        connection.commit.assert_not_called()
+        pool.putconn.assert_called_once_with(connection)
+
+    def test_columns_must_match_schema(self):
+        with self.assertRaises(AssertionError):
+            data_utils.upsert_data(self.make_results(['2020-05-01']).drop('score', axis=1), auth={})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Tests of the grouping of filters into crawls (utils.plan_utils) and of the split of a crawl between its filters.
+
+Usage (from the root of the repo):
+    python -m pytest tests
+"""
+import os
+import sys
+import json
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from tests.crawler_env import import_base
+from benchmarks.synthetic import generate_listings, to_record
+from utils.plan_utils import filters_mergeable, plan_crawls, filter_mask
+
+with open(os.path.join(ROOT, 'input.json')) as f:
+    INPUT = json.load(f)
+
+
+def make_filter(**kwargs):
+    filter_ = {'title': None, 'site': 'sfbay', 'area': 'sfc', 'price_min': 3000, 'price_max': 5000,
+               'min_bedrooms': 2, 'max_bedrooms': 2, 'min_ft2': 500}
+    filter_.update(kwargs)
+    return filter_
+
+
+class TestPlanCrawls(unittest.TestCase):
+    def test_mergeable(self):
+        self.assertTrue(filters_mergeable(make_filter(), make_filter(min_bedrooms=3, max_bedrooms=3)))
+        self.assertTrue(filters_mergeable(make_filter(), make_filter(min_bedrooms=1, max_bedrooms=1)))
+        # distant bedrooms, disjoint prices, other area
+        self.assertFalse(filters_mergeable(make_filter(), make_filter(min_bedrooms=4, max_bedrooms=4)))
+        self.assertFalse(filters_mergeable(make_filter(), make_filter(price_min=5001, price_max=6000)))
+        self.assertFalse(filters_mergeable(make_filter(), make_filter(area='sby')))
+
+    def test_input_filters(self):
+        l_filters = INPUT['filters']
+        l_plans = plan_crawls(l_filters)
+        d_members = {tuple(i for i, _ in plan['members']): plan['filters'] for plan in l_plans}
+        # 2 and 3 bedrooms are crawled together, 1 bedroom (lower prices) alone
+        self.assertEqual(sorted(d_members.keys()), [(0, 1), (2,)])
+        superset = d_members[(0, 1)]
+        self.assertEqual((superset['price_min'], superset['price_max']), (3500, 7000))
+        self.assertEqual((superset['min_bedrooms'], superset['max_bedrooms'], superset['min_ft2']), (2, 3, 700))
+
+    def test_transitive(self):
+        l_filters = [make_filter(min_bedrooms=1, max_bedrooms=1), make_filter(min_bedrooms=3, max_bedrooms=3),
+                     make_filter(min_bedrooms=2, max_bedrooms=2)]
+        self.assertEqual([[i for i, _ in plan['members']] for plan in plan_crawls(l_filters)], [[0, 1, 2]])
+
+
+class TestSubset(unittest.TestCase):
+    def test_subset_input_filters(self):
+        base = import_base()
+        l_filters = INPUT['filters']
+        plan = [plan for plan in plan_crawls(l_filters) if len(plan['members']) > 1][0]
+
+        hc_plan = base.HousingCrawler(filters=plan['filters'], destination=INPUT['destination'], mode=INPUT['mode'],
+                                      posted_today=False, prune_travel=False, isochrones=False)
+        hc_plan.res = [to_record(listing) for listing in generate_listings(500, seed=1)]
+        hc_plan.format_data()
+        hc_plan.set_destinations_modes()
+        df_plan = hc_plan.df_res
+
+        for i, filter_ in plan['members']:
+            hc = hc_plan.subset(filter_, score=False)
+            # the listings of the crawl matching filter_, and only those
+            self.assertGreater(hc.df_res.shape[0], 0)
+            self.assertEqual(sorted(hc.df_res.id), sorted(df_plan[filter_mask(df_plan, filter_)].id))
+            self.assertTrue(filter_mask(hc.df_res, filter_).all())
+            self.assertTrue((hc.df_res.bedrooms == filter_['min_bedrooms']).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Tests of HousingCrawler.score_lazy against the eager path (enrich_traveldata then score), with the travel lookups
+answered by a local stub of get_travel_matrix.
+
+Usage (from the root of the repo):
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from tests.crawler_env import import_base
+from benchmarks.synthetic import generate_listings, to_record
+from benchmarks.stub_servers import MODE_SPEEDS
+from utils.geo_utils import haversine
+
+FILTERS = {'title': 'lazy', 'site': 'sfbay', 'area': 'sfc', 'price_min': 0, 'price_max': 100000,
+           'min_bedrooms': 0, 'max_bedrooms': 3, 'min_ft2': 0}
+DESTINATIONS = {'Uber': {'lat': 37.775905, 'lng': -122.418339}, 'Dropbox': {'lat': 37.766622, 'lng': -122.392408}}
+MODES = ['bicycling', 'transit', 'walking']
+
+
+class TravelMatrixStub(object):
+    """Stands in for get_travel_matrix: distance (km) and duration (min) at the speeds of the Distance Matrix stub."""
+    def __init__(self):
+        self.n_lookups = 0
+
+    def __call__(self, l_origins, destinations, l_modes, max_workers=None, d_known=None):
+        d_travel = dict(d_known or {})
+        for mode in l_modes:
+            for dest_name, dest_lat_lng in destinations.items():
+                for origin in l_origins:
+                    if (origin, dest_name, mode) in d_travel:
+                        continue
+                    self.n_lookups += 1
+                    meters = float(haversine(origin[0], origin[1], dest_lat_lng['lat'], dest_lat_lng['lng']))
+                    d_travel[(origin, dest_name, mode)] = (round(meters / 1000, 2), int(meters / MODE_SPEEDS[mode] / 60))
+        return d_travel
+
+
+class TestScoreLazy(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.base = import_base()
+        cls.records = [to_record(listing) for listing in generate_listings(600, seed=5)]
+
+    def make_crawler(self, lazy):
+        hc = self.base.HousingCrawler(filters=FILTERS, destination=DESTINATIONS, mode=MODES, posted_today=False,
+                                      prune_travel=False, isochrones=False, lazy=lazy)
+        hc.res = list(self.records)
+        hc.format_data()
+        return hc
+
+    def test_same_scores(self):
+        stub_eager = TravelMatrixStub()
+        hc_eager = self.make_crawler(lazy=False)
+        with mock.patch.object(self.base, 'get_travel_matrix', stub_eager):
+            hc_eager.enrich_traveldata()
+            hc_eager.score()
+
+        stub_lazy = TravelMatrixStub()
+        hc_lazy = self.make_crawler(lazy=True)
+        hc_lazy.set_destinations_modes()
+        with mock.patch.object(self.base, 'get_travel_matrix', stub_lazy):
+            hc_lazy.score_lazy()
+
+        score_eager = hc_eager.df_res.set_index('id').score
+        score_lazy = hc_lazy.df_res.set_index('id').score.reindex(score_eager.index)
+        # some listings score above 0, the others are not all pruned by ppsqft
+        self.assertGreater((score_eager > 0).sum(), 0)
+        self.assertGreater((score_eager == 0).sum(), 0)
+        np.testing.assert_allclose(score_lazy.values, score_eager.values, rtol=0, atol=1e-12)
+        self.assertEqual(hc_lazy.url_top, hc_eager.url_top)
+        self.assertEqual(hc_lazy.url_considered, hc_eager.url_considered)
+        # the lazy path skips the lookups that can't change a score
+        self.assertGreater(stub_lazy.n_lookups, 0)
+        self.assertLess(stub_lazy.n_lookups, stub_eager.n_lookups)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests of the vectorized scores (utils.score_utils) against the row-wise scores they replace
+(HousingCrawler.normalize_val applied to each value, max of mode scores and geometric_mean of each row).
+
+Usage (from the root of the repo):
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from tests.crawler_env import import_base
+from constants import SCORE_BOUNDS
+from utils.score_utils import normalize_array, column_score, max_score, geometric_mean_array
+
+DESTINATIONS = {'Uber': {'lat': 37.775905, 'lng': -122.418339}, 'Dropbox': {'lat': 37.766622, 'lng': -122.392408}}
+MODES = ['bicycling', 'transit', 'walking']
+
+
+def make_values(n, low, high, bounds, seed):
+    """Random values between low and high with missing values, zeros and the bounds themselves."""
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(low, high, n)
+    values[rng.random(n) < 0.1] = np.nan
+    values[:4] = [0., bounds['min'], bounds['max'], np.nan]
+    return values
+
+
+class TestScores(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        base = import_base()
+        cls.HousingCrawler = base.HousingCrawler
+        cls.geometric_mean = staticmethod(base.geometric_mean)
+
+    def row_score(self, val, val_name):
+        bounds = SCORE_BOUNDS[val_name]
+        return self.HousingCrawler.normalize_val(val, min_bound=bounds['min'], max_bound=bounds['max'])
+
+    def test_column_score(self):
+        for val_name in ['ppsqft'] + MODES:
+            bounds = SCORE_BOUNDS[val_name]
+            values = make_values(500, 0, 2 * bounds['max'], bounds, seed=len(val_name))
+            expected = [self.row_score(val, val_name) for val in values]
+            # missing values score 1, as normalize_val does (min(1, nan) returns 1)
+            np.testing.assert_allclose(column_score(values, val_name), expected, rtol=0, atol=1e-12)
+            np.testing.assert_allclose(column_score(pd.Series(values), val_name), expected, rtol=0, atol=1e-12)
+
+    def test_column_score_missing(self):
+        values = make_values(200, 0, 60, SCORE_BOUNDS['walking'], seed=1)
+        expected = [0. if np.isnan(val) else self.row_score(val, 'walking') for val in values]
+        np.testing.assert_allclose(column_score(values, 'walking', missing=0.), expected, rtol=0, atol=1e-12)
+        # values that can't be parsed are missing
+        self.assertEqual(normalize_array(['abc', None, 5], 0, 10, missing=0.).tolist(), [0., 0., .5])
+
+    def test_max_score(self):
+        rng = np.random.default_rng(2)
+        l_scores = [rng.choice([0., .25, .5, 1.], 300) for _ in MODES]
+        expected = pd.DataFrame(np.column_stack(l_scores)).max(axis=1).values
+        np.testing.assert_array_equal(max_score(l_scores), expected)
+
+    def test_geometric_mean(self):
+        rng = np.random.default_rng(3)
+        scores = rng.uniform(0, 1, (300, 3))
+        scores[rng.random((300, 3)) < 0.1] = 0.
+        scores[rng.random((300, 3)) < 0.1] = 1.
+        expected = [self.geometric_mean(list(row)) for row in scores]
+        np.testing.assert_allclose(geometric_mean_array(scores), expected, rtol=1e-12, atol=0)
+
+    def test_geometric_mean_missing(self):
+        scores = np.array([[.25, np.nan, 1.], [0., np.nan, .5], [np.nan, np.nan, np.nan], [.5, .5, .5]])
+        # missing scores are ignored
+        expected = [self.geometric_mean([.25, 1.]), 0., np.nan, .5]
+        np.testing.assert_allclose(geometric_mean_array(scores), expected, rtol=1e-12, atol=0)
+
+    def test_score_rows(self):
+        """HousingCrawler.score is the same as the row-wise scores, with missing travel durations scoring 0."""
+        n_rows = 400
+        df = pd.DataFrame({
+            'url': ['https://sfbay.craigslist.org/{}.html'.format(i) for i in range(n_rows)],
+            'ppsqft': make_values(n_rows, 0, 10, SCORE_BOUNDS['ppsqft'], seed=4)
+        })
+        for i, (dest_name, mode_) in enumerate([(dest_name, mode_) for dest_name in DESTINATIONS for mode_ in MODES]):
+            df['_'.join(['duration', dest_name, mode_])] = make_values(n_rows, 0, 60, SCORE_BOUNDS[mode_], seed=10 + i)
+
+        hc = self.HousingCrawler(site='sfbay', area='sfc', n_beds=2, price_min=0, price_max=10000, area_min=0,
+                                 destination=DESTINATIONS, mode=MODES)
+        hc.set_destinations_modes()
+        hc.df_res = df.copy()
+        hc.score()
+
+        # row-wise scores
+        expected = df.copy()
+        expected['ppsqft_score'] = expected.ppsqft.apply(lambda x: self.row_score(x, 'ppsqft'))
+        for dest_name in DESTINATIONS:
+            l_mode_scores = []
+            for mode_ in MODES:
+                score_name = '_'.join([mode_, dest_name, 'score'])
+                expected[score_name] = expected['_'.join(['duration', dest_name, mode_])].apply(
+                    lambda x: 0. if np.isnan(x) else self.row_score(x, mode_))
+                l_mode_scores.append(score_name)
+            expected['_'.join(['travel', dest_name, 'score'])] = expected[l_mode_scores].max(axis=1)
+        l_all_scores = ['ppsqft_score'] + ['_'.join(['travel', dest_name, 'score']) for dest_name in DESTINATIONS]
+        expected['score'] = expected[l_all_scores].apply(lambda row: self.geometric_mean(list(row)), axis=1)
+
+        df_res = hc.df_res.sort_index()
+        for col in expected.columns:
+            if col.endswith('score'):
+                np.testing.assert_allclose(df_res[col].values, expected[col].values, rtol=1e-12, atol=1e-12, err_msg=col)
+        # listings are ranked by score
+        self.assertTrue((np.diff(hc.df_res.score.values) <= 0).all())
+        self.assertEqual(hc.url_considered, hc.df_res[hc.df_res.score != 0].url.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,38 +1,30 @@
 from numbers import Number
-import requests
 import logging 
 import datetime
-import time
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 import numpy as np
-from cachier import cachier
 from credentials import API_KEY
 
-from constants import CACHE_DIR
+from constants import CACHE_DIR, DISTANCE_MATRIX_URL, DISTANCE_MATRIX_MAX_ORIGINS, \
+    DISTANCE_MATRIX_MAX_DESTINATIONS, DISTANCE_MATRIX_MAX_ELEMENTS, TRAVEL_RATE_LIMIT, \
+    TRAVEL_MAX_ATTEMPTS, TRAVEL_BACKOFF, TRAVEL_MAX_WORKERS, TRAVEL_STORE_PARAMS, DATETIME_FORMAT, LATLNG_KEY_SCALE
+from utils.http_utils import RateLimiter, get_retry_after, get_session, get_session_stats, requests_retry_session
+from utils.store_utils import TravelStore
+from utils.estimate_utils import TravelEstimator
+from utils.cache_utils import cached
 
 logging.root.setLevel(logging.DEBUG)
 
-def requests_retry_session(
-    retries=3,
-    backoff_factor=1,
-    status_forcelist=(500, 502, 504),
-    session=None,
-    ):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+# rate limiter consulted before each request to the travel API
+TRAVEL_RATE_LIMITER = RateLimiter(**TRAVEL_RATE_LIMIT)
+# persistent travel-time store looked up before calling the travel API
+TRAVEL_STORE = TravelStore(**TRAVEL_STORE_PARAMS)
+# local lower bounds of travel times (speeds calibrated from the travel store) used to skip hopeless lookups
+TRAVEL_ESTIMATOR = TravelEstimator(TRAVEL_STORE)
+# prices and areas from this value on do not fit in int64 (listings having them are removed by normalize_listings)
+INT64_MAX = np.iinfo(np.int64).max
 
 # data utils 
 
@@ -58,7 +50,7 @@ def geometric_mean(l):
 def format_sqft(x):
     """Converts sqft input into integer."""
     if isinstance(x, Number):
-        return int(x) + A
+        return int(x)
     elif x[:x.find('ft2')].isnumeric():
         return int(x[:x.find('ft2')])
     else:
@@ -160,21 +152,128 @@ def get_lng(x):
     else:
         return x[1]
 
+def format_sqft_series(s_area):
+    """Vectorized format_sqft: converts sqft column into floats (NaN if it can't be parsed)."""
+    numeric = pd.to_numeric(s_area, errors='coerce')
+    parsed = s_area.astype(str).str.extract(r'^\s*(\d+)\s*ft2', expand=False)
+    return numeric.fillna(pd.to_numeric(parsed, errors='coerce')).astype(float)
 
-@cachier(stale_after=datetime.timedelta(days=30), cache_dir=CACHE_DIR)
-def get_travel_info(origin, destination, mode='walking'):
+def format_price_series(s_price):
+    """Vectorized format_price: converts price column into floats (NaN if it can't be parsed)."""
+    numeric = pd.to_numeric(s_price, errors='coerce')
+    parsed = s_price.astype(str).str.extract(r'^\s*\$?\s*([\d,]+)\s*$', expand=False).str.replace(',', '')
+    return numeric.fillna(pd.to_numeric(parsed, errors='coerce')).astype(float)
+
+def records_to_frame(records, l_columns):
     """
-    Returns the distance and duration from origin to destination using mode of transportation.
-    
-    :params origin: tuple (lat, lng) of origin
-    :params destination: dict with keys (lat, lng) of destination
+    Builds a DataFrame column by column from crawled records, without an intermediate frame of dicts or tuples.
+    The geotag of records is split into the float columns lat and lng (NaN if missing).
+
+    :params records: list of dicts of listings
+    :params l_columns: list of columns (lat and lng are taken from the geotag)
+    """
+    d_columns = {col: [record.get(col) for record in records] for col in l_columns if col not in ('lat', 'lng')}
+    coords = np.array(
+        [record.get('geotag') or (np.nan, np.nan) for record in records], dtype=np.float64
+        ).reshape(-1, 2)
+    d_columns['lat'] = coords[:, 0]
+    d_columns['lng'] = coords[:, 1]
+    return pd.DataFrame(d_columns, columns=l_columns)
+
+def normalize_listings(df_res, l_columns, thresh=10):
+    """
+    Cleans crawled listings with vectorized operations and typed columns: price and area as int64, bedrooms and
+    bathrooms as float32, timestamps as datetime64, lat and lng as float64, plus ppsqft and the int32 keys of the
+    rounded coordinates lat_key and lng_key (see LATLNG_KEY_SCALE), used for lookups only.
+    Listings with small description, 0, negative, too large or missing price or area, or missing coordinates are removed
+    with one combined mask.
+
+    :params df_res: pd DataFrame with columns ["body", "price", "area", "lat", "lng"] (see records_to_frame)
+    :params l_columns: list of columns to keep
+    :params thresh: exclude listing whose description length is below thresh
+    """
+    small_desc = df_res.body.astype(str).str.len() <= thresh
+    price = format_price_series(df_res.price)
+    area = format_sqft_series(df_res.area)
+    d_removed = {
+        'the description is below {}'.format(thresh): small_desc,
+        'they have 0 in price': price == 0,
+        'they have 0 in area': area == 0,
+        'they have an out of range price or area': (price < 0) | (price >= INT64_MAX) | (area < 0) | (area >= INT64_MAX),
+        'they have None in price, area or geotag': price.isnull() | area.isnull() | df_res.lat.isnull() | df_res.lng.isnull(),
+    }
+    to_remove = np.logical_or.reduce(list(d_removed.values()))
+
+    # spit logs if rows are being removed
+    for reason, rows in d_removed.items():
+        if rows.sum() > 0:
+            logging.info({'msg': 'Number of rows removed because {reason} are: {n_rows}'.format(
+                reason=reason,
+                n_rows=rows.sum()
+            )})
+
+    df_res = df_res.loc[~to_remove, l_columns]
+    price = price[~to_remove].values
+    area = area[~to_remove].values
+    lat = df_res.lat.values
+    lng = df_res.lng.values
+
+    d_columns = {
+        col: pd.to_datetime(df_res[col], format=DATETIME_FORMAT, errors='coerce')
+        for col in ['datetime', 'created', 'last_updated'] if col in df_res.columns
+    }
+    d_columns.update({
+        col: pd.to_numeric(df_res[col], errors='coerce').astype(np.float32)
+        for col in ['bedrooms', 'bathrooms'] if col in df_res.columns
+    })
+    df_res = df_res.assign(
+        price=price.astype(np.int64),
+        area=area.astype(np.int64),
+        # price per sqft
+        ppsqft=price / area,
+        lat=lat.astype(np.float64),
+        lng=lng.astype(np.float64),
+        # keys of the rounded coordinates (listings sharing them share travel data)
+        lat_key=np.rint(lat * LATLNG_KEY_SCALE).astype(np.int32),
+        lng_key=np.rint(lng * LATLNG_KEY_SCALE).astype(np.int32),
+        **d_columns
+        )
+    return df_res
+
+def get_origins(df_res):
     """
-    base_url = "https://maps.googleapis.com/maps/api/distancematrix/json?&origins={lat_origin}%2C{lng_origin}&destinations={lat_dest}%2C{lng_dest}&units=metric&mode={mode}&key={key}"
+    Returns the unique rounded coordinates of listings (in order of first appearance) and the origin of each listing.
+
+    :params df_res: pd DataFrame with columns ["lat_key", "lng_key"] (see normalize_listings)
+
+    :output origin_codes: np array of the index in l_origins of the origin of each listing
+    :output l_origins: list of tuples (lat, lng) of unique origins
+    """
+    lat_key = df_res.lat_key.values.astype(np.int64)
+    lng_key = df_res.lng_key.values.astype(np.int64)
+    # lng_key is within +-180 * LATLNG_KEY_SCALE
+    origin_codes, _ = pd.factorize(lat_key * (4 * 180 * LATLNG_KEY_SCALE) + lng_key)
+    first = np.unique(origin_codes, return_index=True)[1]
+    l_origins = list(zip(
+        (lat_key[first] / LATLNG_KEY_SCALE).tolist(),
+        (lng_key[first] / LATLNG_KEY_SCALE).tolist()
+        ))
+    return origin_codes, l_origins
+
+
+def build_travel_url(l_origins, l_destinations, mode='walking'):
+    """
+    Builds the Distance Matrix request url from all origins to all destinations.
+
+    :params l_origins: list of tuples (lat, lng) of origins
+    :params l_destinations: list of dicts with keys (lat, lng) of destinations
+    :params mode: mode of transportation
+    """
+    base_url = "{url}?&origins={origins}&destinations={destinations}&units=metric&mode={mode}&key={key}"
     request_url = base_url.format(
-        lat_origin=origin[0],
-        lng_origin=origin[1],
-        lat_dest=destination.get("lat"),
-        lng_dest=destination.get("lng"),
+        url=DISTANCE_MATRIX_URL,
+        origins="%7C".join(["{}%2C{}".format(o[0], o[1]) for o in l_origins]),
+        destinations="%7C".join(["{}%2C{}".format(d.get("lat"), d.get("lng")) for d in l_destinations]),
         mode=mode,
         key=API_KEY
     )
@@ -184,32 +283,209 @@ def get_travel_info(origin, destination, mode='walking'):
             "transit_routing_preference=less_walking",
             "departure_time={}".format(next_weekday()) # next monday 9am 
         ])
-        
-    res = requests_retry_session(retries=3).get(request_url)
-    
+    return request_url
+
+def request_travel(request_url, max_attempts=TRAVEL_MAX_ATTEMPTS):
+    """
+    Sends a request to the travel API once the rate limiter allows it.
+    The request is retried after waiting if the API answers that the quota is exceeded.
+
+    :params request_url: url of the request
+    :params max_attempts: maximum number of attempts
+    """
+    for attempt in range(max_attempts):
+        TRAVEL_RATE_LIMITER.acquire()
+        res = get_session().get(request_url)
+
+        retry_after = get_retry_after(res)
+        if retry_after is None and (res.status_code == 429 or is_over_query_limit(res)):
+            retry_after = TRAVEL_BACKOFF * 2 ** attempt
+        if retry_after is None:
+            return res
+
+        logging.warning({
+            'msg': 'travel API quota exceeded, retrying in {} seconds'.format(retry_after),
+            'attempt': attempt + 1
+        })
+        # block all requests (threads and processes) sharing the limiter
+        TRAVEL_RATE_LIMITER.penalize(retry_after)
+    return res
+
+def is_over_query_limit(res):
+    """Returns True if the travel API response says that the quota is exceeded."""
+    try:
+        return res.json().get('status') == 'OVER_QUERY_LIMIT'
+    except ValueError:
+        return False
+
+def get_matrix_elements(res, n_origins, n_destinations):
+    """
+    Returns the matrix (list of rows) of elements of a Distance Matrix response.
+    Elements are empty dicts if the response is not valid.
+    """
     try:
-        dist_meters = res.json()['rows'][0]['elements'][0]['distance']['value'] # distance in meters
+        l_rows = [row['elements'] for row in res.json()['rows']]
+        assert len(l_rows) == n_origins and all([len(row) == n_destinations for row in l_rows])
+    except Exception as e:
+        logging.critical({
+            'error': e,
+            'request' : res.text
+        })
+        l_rows = [[dict() for _ in range(n_destinations)] for _ in range(n_origins)]
+    return l_rows
+
+def parse_travel_element(element):
+    """Returns the distance (km) and duration (min) of a Distance Matrix element."""
+    try:
+        dist_meters = element['distance']['value'] # distance in meters
         dist = round(dist_meters / 1000, 2) # convert to km 
     except Exception as e:
         logging.critical({
             'error': e,
-            'request' : res.json()
+            'element' : element
         })
         dist = None
     
     try:
-        duration_seconds = res.json()['rows'][0]['elements'][0]['duration']['value'] # distance in meters
+        duration_seconds = element['duration']['value'] # duration in seconds
         duration = int(duration_seconds / 60) # converts to min 
     except Exception as e:
         logging.critical({
             'error': e,
-            'request' : res.json()
+            'element' : element
         })
         duration = None
-        
-    # sleep in order not to stay below quota
-    time.sleep(1.5)
+    return dist, duration
+
+
+@cached(stale_after=datetime.timedelta(days=30), cache_dir=CACHE_DIR)
+def get_travel_info(origin, destination, mode='walking'):
+    """
+    Returns the distance and duration from origin to destination using mode of transportation.
+    
+    :params origin: tuple (lat, lng) of origin
+    :params destination: dict with keys (lat, lng) of destination
+    """
+    # reuse a stored result of a close enough origin
+    stored = TRAVEL_STORE.get(origin, destination=destination, mode=mode)
+    if stored is not None:
+        return stored
+
+    request_url = build_travel_url([origin], [destination], mode=mode)
+    res = request_travel(request_url)
+    
+    element = get_matrix_elements(res, n_origins=1, n_destinations=1)[0][0]
+    dist, duration = parse_travel_element(element)
+    if dist is not None and duration is not None:
+        TRAVEL_STORE.put_many([(origin, destination, mode, dist, duration)])
 
     return dist, duration 
 
+def get_travel_info_chunk(l_origins, destinations, mode='walking'):
+    """
+    Returns the distance and duration from all origins to all destinations using a single request.
+    Successful results are added to the travel store and to the cache of get_travel_info (one transaction each).
+
+    :params l_origins: list of tuples (lat, lng) of origins
+    :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+
+    :output d_travel: dict with keys (origin, dest_name) and values (distance, duration)
+    """
+    l_dest_names = list(destinations.keys())
+    request_url = build_travel_url(l_origins, [destinations[name] for name in l_dest_names], mode=mode)
+    res = request_travel(request_url)
+
+    l_rows = get_matrix_elements(res, n_origins=len(l_origins), n_destinations=len(l_dest_names))
+    d_travel = dict()
+    l_records = []
+    l_calls = []
+    for origin, l_elements in zip(l_origins, l_rows):
+        for dest_name, element in zip(l_dest_names, l_elements):
+            dist, duration = parse_travel_element(element)
+            d_travel[(origin, dest_name)] = (dist, duration)
+            if dist is not None and duration is not None:
+                l_records.append((origin, destinations[dest_name], mode, dist, duration))
+                l_calls.append(((origin,), {'destination': destinations[dest_name], 'mode': mode}, (dist, duration)))
+    # fill the per pair cache so that single lookups hit
+    get_travel_info.precache_values(l_calls)
+    TRAVEL_STORE.put_many(l_records)
+
+    return d_travel
+
+def chunk_travel_requests(l_origins, destinations):
+    """
+    Splits origins and destinations in chunks that fit in a single Distance Matrix request.
+
+    :params l_origins: list of tuples (lat, lng) of origins
+    :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+
+    :output: generator of (list of origins, dict of destinations)
+    """
+    l_dest_names = list(destinations.keys())
+    for i in range(0, len(l_dest_names), DISTANCE_MATRIX_MAX_DESTINATIONS):
+        dest_chunk = {name: destinations[name] for name in l_dest_names[i:i + DISTANCE_MATRIX_MAX_DESTINATIONS]}
+        # number of origins that fit in one request with this number of destinations
+        n_origins = min(DISTANCE_MATRIX_MAX_ORIGINS, DISTANCE_MATRIX_MAX_ELEMENTS // len(dest_chunk))
+        for j in range(0, len(l_origins), n_origins):
+            yield l_origins[j:j + n_origins], dest_chunk
+
+def get_travel_info_batch(l_origins, destinations, mode='walking'):
+    """
+    Returns the distance and duration from all origins to all destinations using mode of transportation.
+    Origins and destinations are packed in as few requests as the Distance Matrix element limits allow.
+
+    :params l_origins: list of tuples (lat, lng) of origins
+    :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+    :params mode: mode of transportation
+
+    :output d_travel: dict with keys (origin, dest_name) and values (distance, duration)
+    """
+    d_travel = dict()
+    for origin_chunk, dest_chunk in chunk_travel_requests(l_origins, destinations):
+        d_travel.update(get_travel_info_chunk(origin_chunk, destinations=dest_chunk, mode=mode))
+    return d_travel
+
+def get_travel_matrix(l_origins, destinations, l_modes, max_workers=TRAVEL_MAX_WORKERS, d_known=None):
+    """
+    Returns the distance and duration from all origins to all destinations for all modes of transportation.
+    Results are first looked up in the travel store; the missing ones are requested in batches
+    sent concurrently by at most max_workers threads (the rate limiter still applies).
+
+    :params l_origins: list of tuples (lat, lng) of origins
+    :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+    :params l_modes: list of modes of transportation
+    :params max_workers: maximum number of concurrent requests
+    :params d_known: dict with keys (origin, dest_name, mode) and values (distance, duration) that are not looked up
+    (e.g. interpolations of the isochrone grid, or NaN for the lookups pruned by TravelEstimator.prune)
+
+    :output d_travel: dict with keys (origin, dest_name, mode) and values (distance, duration)
+    """
+    d_travel = dict(d_known or {})
+    # requests to send: (mode, destinations missing) -> origins
+    d_missing = dict()
+    for mode in l_modes:
+        for origin in l_origins:
+            l_dest_missing = []
+            for dest_name, dest_lat_lng in destinations.items():
+                if (origin, dest_name, mode) in d_travel:
+                    continue
+                stored = TRAVEL_STORE.get(origin, destination=dest_lat_lng, mode=mode)
+                if stored is None:
+                    l_dest_missing.append(dest_name)
+                else:
+                    d_travel[(origin, dest_name, mode)] = stored
+            if len(l_dest_missing) > 0:
+                d_missing.setdefault((mode, tuple(l_dest_missing)), []).append(origin)
 
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        d_futures = dict()
+        for (mode, dest_names), l_origins_missing in d_missing.items():
+            dest_missing = {name: destinations[name] for name in dest_names}
+            for origin_chunk, dest_chunk in chunk_travel_requests(l_origins_missing, dest_missing):
+                future = executor.submit(get_travel_info_chunk, origin_chunk, destinations=dest_chunk, mode=mode)
+                d_futures[future] = mode
+        for future in as_completed(d_futures):
+            mode = d_futures[future]
+            for (origin, dest_name), dist_dur in future.result().items():
+                d_travel[(origin, dest_name, mode)] = dist_dur
+    return d_travel
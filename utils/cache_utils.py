@@ -0,0 +1,189 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import inspect
+import threading
+import functools
+
+from constants import CACHE_DIR, CACHE_MAX_ENTRIES
+
+
+class SQLiteCache(object):
+    # number of writes between two evictions of expired entries and checks of the size of the cache
+    EVICTION_PERIOD = 100
+
+    def __init__(self, path, stale_after=None, max_entries=None):
+        """
+        Key value cache stored in SQLite, safe to share between threads and processes.
+        Entries older than stale_after are expired and the least recently used entries are evicted above max_entries.
+
+        :params path: path of the SQLite database
+        :params stale_after: datetime.timedelta after which an entry is expired (never if None)
+        :params max_entries: maximum number of entries (unbounded if None)
+        """
+        self.path = path
+        self.stale_after = stale_after.total_seconds() if stale_after is not None else None
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._n_writes = 0
+
+        # counters
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_expired = 0
+        self.n_evicted = 0
+
+    def _connect(self):
+        """Returns the connection of the current thread (created and initialized on first call)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            with self._lock:
+                if not self._initialized:
+                    connection.execute("""CREATE TABLE IF NOT EXISTS cache(
+                        key TEXT PRIMARY KEY,
+                        value BLOB,
+                        created REAL,
+                        last_access REAL)""")
+                    connection.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache(last_access)")
+                    connection.commit()
+                    self._initialized = True
+            self._local.connection = connection
+        return connection
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def get(self, key):
+        """
+        Returns (True, value) if key is cached and not expired, (False, None) otherwise.
+        """
+        connection = self._connect()
+        row = connection.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is not None and self.stale_after is not None and now - row[1] > self.stale_after:
+            with connection:
+                connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._count('n_expired')
+            row = None
+
+        if row is None:
+            self._count('n_misses')
+            return False, None
+
+        with connection:
+            connection.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+        self._count('n_hits')
+        return True, pickle.loads(row[0])
+
+    def set(self, key, value):
+        """Caches value under key."""
+        self.set_many([(key, value)])
+
+    def set_many(self, l_items):
+        """Caches a list of (key, value) in a single transaction."""
+        if len(l_items) == 0:
+            return
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache(key, value, created, last_access) VALUES (?, ?, ?, ?)",
+                [(key, pickle.dumps(value), now, now) for key, value in l_items]
+                )
+        with self._lock:
+            n_writes_before = self._n_writes
+            self._n_writes += len(l_items)
+            check_size = (self.max_entries is not None or self.stale_after is not None) and \
+                self._n_writes // self.EVICTION_PERIOD != n_writes_before // self.EVICTION_PERIOD
+        if check_size:
+            self.evict()
+
+    def evict(self):
+        """Removes the expired entries and the least recently used entries above max_entries."""
+        connection = self._connect()
+        with connection:
+            if self.stale_after is not None:
+                n_expired = connection.execute(
+                    "DELETE FROM cache WHERE created < ?", (time.time() - self.stale_after,)
+                    ).rowcount
+                self._count('n_expired', n_expired)
+            if self.max_entries is None:
+                return
+            n_entries = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            n_over = n_entries - self.max_entries
+            if n_over > 0:
+                connection.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access LIMIT ?)", (n_over,)
+                    )
+                self._count('n_evicted', n_over)
+
+    def clear(self):
+        """Removes all entries."""
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM cache")
+
+    def get_stats(self):
+        """Returns the hit, miss, expiry and eviction counters of the cache."""
+        with self._lock:
+            return {
+                'n_hits': self.n_hits,
+                'n_misses': self.n_misses,
+                'n_expired': self.n_expired,
+                'n_evicted': self.n_evicted
+            }
+
+
+def cached(stale_after=None, cache_dir=CACHE_DIR, max_entries=CACHE_MAX_ENTRIES):
+    """
+    Decorator caching the results of a function in a SQLiteCache stored in cache_dir.
+    The key is the hash of all arguments (defaults included) so positional and keyword calls share entries.
+    The decorated function has the attributes cache, precache_value(*args, value_to_cache, **kwds),
+    precache_values(l_calls) (list of (args, kwds, value) written in one transaction) and clear_cache().
+
+    :params stale_after: datetime.timedelta after which a result is recomputed
+    :params cache_dir: directory of the cache
+    :params max_entries: maximum number of cached results
+    """
+    def decorator(func):
+        cache = SQLiteCache(
+            path=os.path.join(cache_dir, '{}.sqlite'.format(func.__qualname__)),
+            stale_after=stale_after,
+            max_entries=max_entries
+            )
+        signature = inspect.signature(func)
+
+        def get_key(args, kwds):
+            bound = signature.bind(*args, **kwds)
+            bound.apply_defaults()
+            return hashlib.sha256(pickle.dumps(sorted(bound.arguments.items()))).hexdigest()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            key = get_key(args, kwds)
+            hit, value = cache.get(key)
+            if hit:
+                return value
+            value = func(*args, **kwds)
+            cache.set(key, value)
+            return value
+
+        def precache_value(*args, value_to_cache, **kwds):
+            cache.set(get_key(args, kwds), value_to_cache)
+
+        def precache_values(l_calls):
+            cache.set_many([(get_key(args, kwds), value) for args, kwds, value in l_calls])
+
+        wrapper.cache = cache
+        wrapper.precache_value = precache_value
+        wrapper.precache_values = precache_values
+        wrapper.clear_cache = cache.clear
+        return wrapper
+    return decorator
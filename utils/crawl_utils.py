@@ -0,0 +1,354 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+from urllib.parse import urlparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+from craigslist import CraigslistHousing
+
+from constants import SEEN_LISTINGS_PATH, DETAIL_FETCH, SHARED_DETAILS_MAX
+from utils.base_utils import format_price_series, format_sqft_series
+from utils.http_utils import RateLimiter, get_session, get_retry_after
+
+
+class SeenListings(object):
+    def __init__(self, path):
+        """
+        Persistent index (SQLite) of the listings already crawled for a query with their last_updated.
+
+        :params path: path of the SQLite database
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        """Returns the connection of the current thread (created on first call)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("""CREATE TABLE IF NOT EXISTS seen(
+                query TEXT,
+                id TEXT,
+                last_updated TEXT,
+                crawled REAL,
+                PRIMARY KEY (query, id))""")
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def get(self, query, listing_id):
+        """Returns the last_updated of the listing when it was crawled for query (None if never crawled)."""
+        row = self._connect().execute(
+            "SELECT last_updated FROM seen WHERE query = ? AND id = ?", (query, listing_id)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def put_many(self, query, l_listings):
+        """
+        Marks listings as crawled for query.
+
+        :params query: key of the query (see get_query_key)
+        :params l_listings: list of tuples (id, last_updated)
+        """
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO seen(query, id, last_updated, crawled) VALUES (?, ?, ?, ?)",
+                [(query, listing_id, last_updated, now) for listing_id, last_updated in l_listings]
+                )
+
+
+class SharedDetails(object):
+    def __init__(self, max_entries=SHARED_DETAILS_MAX):
+        """
+        Details of the listings fetched by this process, shared by listing id between the crawls returning the same listings.
+
+        :params max_entries: maximum number of listings kept (least recently used are dropped)
+        """
+        self.max_entries = max_entries
+        self._d_details = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, listing_id, last_updated):
+        """Returns the details added to the listing when it was fetched (None if it was not, or was updated since)."""
+        with self._lock:
+            entry = self._d_details.get(listing_id)
+            if entry is None or entry[0] != last_updated:
+                return None
+            self._d_details.move_to_end(listing_id)
+            return entry[1]
+
+    def put(self, listing_id, last_updated, details):
+        """Keeps the details (dict of fields) added to the listing."""
+        with self._lock:
+            self._d_details[listing_id] = (last_updated, details)
+            self._d_details.move_to_end(listing_id)
+            while len(self._d_details) > self.max_entries:
+                self._d_details.popitem(last=False)
+
+
+class CraigslistHousingRows(CraigslistHousing):
+    """CraigslistHousing whose search results also hold the bedrooms and area shown in the search rows."""
+
+    def process_row(self, row, geotagged=False, include_details=False):
+        result = super(CraigslistHousingRows, self).process_row(row, geotagged=geotagged, include_details=include_details)
+        # e.g. "2br - 750ft2 -" (values from the detail page take precedence)
+        housing = row.find('span', {'class': 'housing'})
+        if housing:
+            for elem in housing.text.split('-'):
+                elem = elem.strip().lower()
+                if elem.endswith('br'):
+                    result.setdefault('bedrooms', elem[:-2])
+                elif elem.endswith('ft2'):
+                    result.setdefault('area', elem)
+        return result
+
+
+# index of listings crawled by incremental crawls
+SEEN_LISTINGS = SeenListings(SEEN_LISTINGS_PATH)
+# details of listings fetched by this process
+SHARED_DETAILS = SharedDetails()
+
+
+def get_query_key(filters, site, area):
+    """Returns a string identifying a crawl query."""
+    return json.dumps({'filters': filters, 'site': site, 'area': area}, sort_keys=True, default=str)
+
+def add_details(cl_h, result, detail_soup):
+    """
+    Adds the geotag and details of the listing page to a search result
+    (same as get_results with geotagged=True and include_details=True).
+
+    :params cl_h: CraigslistHousing object
+    :params result: dict of a search result
+    :params detail_soup: BeautifulSoup of the listing page (None if it could not be fetched)
+    """
+    if detail_soup:
+        cl_h.geotag_result(result, detail_soup)
+        cl_h.include_details(result, detail_soup)
+    if cl_h.custom_result_fields:
+        cl_h.customize_result(result)
+    return result
+
+def fetch_details(cl_h, result):
+    """Fetches the listing page of a search result and adds its geotag and details (see add_details)."""
+    return add_details(cl_h, result, cl_h.fetch_content(result['url']))
+
+
+class DetailFetcher(object):
+    # craigslist serves listing pages to browsers only
+    HEADERS = {'User-Agent': 'Mozilla/5.0'}
+    # statuses retried here: connection errors and 500, 502, 504 are already retried by the session (see HTTP_POOL)
+    RETRY_STATUSES = (429, 503)
+
+    def __init__(self, 
+                 cl_h,
+                 max_workers=DETAIL_FETCH['max_workers'],
+                 per_host=DETAIL_FETCH['per_host'],
+                 delay=DETAIL_FETCH['delay'],
+                 retries=DETAIL_FETCH['retries'],
+                 backoff=DETAIL_FETCH['backoff']
+                ):
+        """
+        Fetches listing pages concurrently through the shared http session.
+
+        :params cl_h: CraigslistHousing object used to parse listing pages
+        :params max_workers: maximum number of concurrent fetches
+        :params per_host: maximum number of concurrent fetches per host
+        :params delay: minimum delay (seconds) between two requests to the same host
+        :params retries: number of retries of a fetch throttled by craigslist (429 or 503)
+        :params backoff: backoff factor (seconds) between retries
+        """
+        self.cl_h = cl_h
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.delay = delay
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._d_semaphores = dict()
+        self._d_limiters = dict()
+
+    def _get_host_limits(self, url):
+        """Returns the semaphore and rate limiter of the host of url."""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._d_semaphores:
+                self._d_semaphores[host] = threading.BoundedSemaphore(self.per_host)
+                self._d_limiters[host] = RateLimiter(rate=1 / self.delay, burst=1) if self.delay > 0 else None
+            return self._d_semaphores[host], self._d_limiters[host]
+
+    def fetch_content(self, url):
+        """
+        Returns the BeautifulSoup of the page (None if it could not be fetched).
+        Only RETRY_STATUSES are retried here, other errors were already retried by the session.
+        """
+        semaphore, limiter = self._get_host_limits(url)
+        for attempt in range(self.retries + 1):
+            try:
+                with semaphore:
+                    if limiter is not None:
+                        limiter.acquire()
+                    res = get_session().get(url, headers=self.HEADERS)
+            except Exception as e:
+                logging.warning({'msg': 'GET {} failed: {} (skipping)'.format(url, e)})
+                return None
+            if res.ok:
+                return BeautifulSoup(res.content, 'html.parser')
+            if res.status_code not in self.RETRY_STATUSES:
+                logging.warning({'msg': 'GET {} returned {} (skipping)'.format(url, res.status_code)})
+                return None
+            logging.warning({'msg': 'GET {} returned {}'.format(url, res.status_code), 'attempt': attempt + 1})
+            if attempt < self.retries:
+                time.sleep(get_retry_after(res) or self.backoff * 2 ** attempt)
+        return None
+
+    def fetch_details(self, result):
+        """
+        Fetches the listing page of a search result and adds its geotag and details (see add_details).
+        Listings already fetched by another crawl of this process are not fetched again (see SHARED_DETAILS).
+        """
+        details = SHARED_DETAILS.get(result['id'], result.get('last_updated'))
+        if details is not None:
+            result.update(details)
+            return result
+        result_before = dict(result)
+        detail_soup = self.fetch_content(result['url'])
+        add_details(self.cl_h, result, detail_soup)
+        if detail_soup:
+            SHARED_DETAILS.put(result['id'], result.get('last_updated'), {
+                key: value for key, value in result.items() if key not in result_before or result_before[key] != value
+            })
+        return result
+
+    def fetch_all(self, l_results):
+        """
+        Fetches the details of all search results concurrently.
+
+        :params l_results: list of dicts of search results
+
+        :output res: list of dicts of listings with details (same order as l_results)
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            res = list(executor.map(self.fetch_details, l_results))
+        return res
+
+
+def pull_data_concurrent(cl_h, limit=None):
+    """
+    Crawls search results, then fetches the details of all results concurrently
+    (same records as get_results with geotagged=True and include_details=True).
+
+    :params cl_h: CraigslistHousing object
+    :params limit: maximum number of search results
+    """
+    l_results = list(cl_h.get_results(limit=limit))
+    return DetailFetcher(cl_h).fetch_all(l_results)
+
+def pull_data_incremental(cl_h, query, seen=SEEN_LISTINGS, limit=None, stop_after=1):
+    """
+    Crawls listings newest first and only fetches the details of listings that are new or updated.
+    The crawl stops once stop_after consecutive listings were already crawled unchanged.
+    Listings are not marked as crawled: call mark_seen once the run has processed them.
+
+    :params cl_h: CraigslistHousing object
+    :params query: key of the query (see get_query_key)
+    :params seen: SeenListings index
+    :params limit: maximum number of search results to go through
+    :params stop_after: number of consecutive known listings after which the crawl stops
+
+    :output res: list of dicts of new or updated listings
+    """
+    l_results = []
+    n_known = 0
+    for result in cl_h.get_results(limit=limit, sort_by='newest'):
+        if seen.get(query, result['id']) == result['last_updated']:
+            n_known += 1
+            if n_known >= stop_after:
+                break
+            continue
+        n_known = 0
+        l_results.append(result)
+    res = DetailFetcher(cl_h).fetch_all(l_results)
+    logging.info({'msg': 'Number of new or updated listings: {}'.format(len(res))})
+    return res
+
+def mark_seen(query, res, seen=SEEN_LISTINGS):
+    """
+    Marks the listings of an incremental crawl as crawled for query, except those whose details could not be fetched
+    (no geotag or body) so that they are crawled again.
+
+    :params query: key of the query (see get_query_key)
+    :params res: list of dicts of listings (see pull_data_incremental)
+    :params seen: SeenListings index
+    """
+    l_listings = [
+        (result['id'], result['last_updated']) for result in res
+        if result.get('geotag') is not None and result.get('body')
+    ]
+    seen.put_many(query, l_listings)
+    logging.info({'msg': 'Number of listings marked as crawled: {} out of {}'.format(len(l_listings), len(res))})
+
+def prefilter_results(l_results, price_min=None, price_max=None, area_min=None, ppsqft_max=None):
+    """
+    Removes search results that would be excluded anyway, using only what search rows provide (price and area).
+    Results whose area is not shown are kept.
+
+    :params l_results: list of dicts of search results
+    :params price_min, price_max: price bounds
+    :params area_min: minimum area
+    :params ppsqft_max: maximum price per sqft (e.g. the ppsqft max of SCORE_BOUNDS, above which the score is 0)
+
+    :output l_survivors: list of dicts of search results
+    """
+    if len(l_results) == 0:
+        return l_results
+    df_results = pd.DataFrame.from_records(l_results, columns=['price', 'area'])
+    price = format_price_series(df_results.price).values
+    area = format_sqft_series(df_results.area).values
+
+    to_remove = np.isnan(price) | (price == 0) | (area == 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if price_min is not None:
+            to_remove |= price < price_min
+        if price_max is not None:
+            to_remove |= price > price_max
+        if area_min is not None:
+            to_remove |= area < area_min
+        if ppsqft_max is not None:
+            to_remove |= price / area > ppsqft_max
+
+    l_survivors = [result for result, remove in zip(l_results, to_remove) if not remove]
+    logging.info({'msg': 'Number of results removed before fetching details: {n_removed} out of {n_results}'.format(
+        n_removed=len(l_results) - len(l_survivors),
+        n_results=len(l_results)
+    )})
+    return l_survivors
+
+def pull_data_two_phase(cl_h, limit=None, price_min=None, price_max=None, area_min=None, ppsqft_max=None):
+    """
+    Crawls search results only, then fetches the details of the results that pass prefilter_results.
+
+    :params cl_h: CraigslistHousing object (CraigslistHousingRows to prefilter on area)
+    :params limit: maximum number of search results
+    :params price_min, price_max, area_min, ppsqft_max: see prefilter_results
+
+    :output res: list of dicts of listings with details
+    """
+    l_results = list(cl_h.get_results(limit=limit))
+    l_survivors = prefilter_results(
+        l_results,
+        price_min=price_min,
+        price_max=price_max,
+        area_min=area_min,
+        ppsqft_max=ppsqft_max
+        )
+    res = DetailFetcher(cl_h).fetch_all(l_survivors)
+    return res
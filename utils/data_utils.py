@@ -1,10 +1,18 @@
-import os 
+import io
+import datetime 
+import threading
+from contextlib import contextmanager
 
 import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 import pandas as pd
-import datetime 
 
-from constants import d_COLUMNS
+from constants import d_COLUMNS, POSTGRES_POOL, COPY_CHUNK_ROWS, DATETIME_FORMAT
+
+# connection pools by database
+_POOLS = dict()
+_POOLS_LOCK = threading.Lock()
 
 
 def format_all_results(l_df):
@@ -24,25 +32,67 @@ def format_all_results(l_df):
     # make id as int 
     df_res_all['id'] = df_res_all.id.astype(int)
     
-    # drop geotag because you can't store tuple in postgres
-    df_res_all.drop(['geotag', 'geotag_rounded'], axis=1, inplace = True)
+    # timestamps are stored as text
+    for col in df_res_all.select_dtypes('datetime').columns:
+        df_res_all[col] = df_res_all[col].dt.strftime(DATETIME_FORMAT)
+
+    # drop the keys of coordinates (not in the schema)
+    df_res_all.drop(['lat_key', 'lng_key'], axis=1, inplace = True)
     
     return df_res_all
 
+def get_pool(auth):
+    """
+    Returns the connection pool of the database of auth (created on first call).
+
+    :params auth: AWS authentication 
+    """
+    key = tuple(sorted(auth.items()))
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ThreadedConnectionPool(
+                POSTGRES_POOL['minconn'],
+                POSTGRES_POOL['maxconn'],
+                host = auth['host'],
+                port = auth['port'],
+                user = auth['user'],
+                password = auth['password'],
+                database=auth['database']
+            )
+        return _POOLS[key]
+
+@contextmanager
+def pooled_connection(auth):
+    """
+    Yields a connection of the pool, commits (or rolls back on error) and gives it back to the pool.
+
+    :params auth: AWS authentication 
+    """
+    pool = get_pool(auth)
+    connection = pool.getconn()
+    try:
+        yield connection
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
 def create_table(table_name, schema, auth):
-    cursor, connection = open_connection(auth)
-    # add schema 
-    cursor.execute(schema)
-    # commit schema 
-    connection.commit()
+    with pooled_connection(auth) as connection:
+        with connection.cursor() as cursor:
+            # add schema 
+            cursor.execute(schema)
 
 def fetch_tables(table_name, auth):
-    cursor, connection = open_connection(auth)
-    # execute statement
-    cursor.execute("""SELECT table_name FROM information_schema.tables
-       WHERE table_schema = 'public'""")
-    # fetch data 
-    l_tables = cursor.fetchall()
+    with pooled_connection(auth) as connection:
+        with connection.cursor() as cursor:
+            # execute statement
+            cursor.execute("""SELECT table_name FROM information_schema.tables
+               WHERE table_schema = 'public'""")
+            # fetch data 
+            l_tables = cursor.fetchall()
     return l_tables
 
 def open_connection(auth):
@@ -56,6 +106,60 @@ def open_connection(auth):
     cursor=connection.cursor()
     return cursor, connection
 
+
+class DataFrameCSV(object):
+    def __init__(self, df, chunk_rows=COPY_CHUNK_ROWS):
+        """
+        File-like object reading a DataFrame as csv (no header), chunk_rows rows at a time.
+        Only one chunk is held in memory, so COPY can stream large DataFrames.
+
+        :params df: pd DataFrame
+        :params chunk_rows: number of rows converted to csv at once
+        """
+        self.df = df
+        self.chunk_rows = chunk_rows
+        self._start = 0
+        self._buffer = io.StringIO()
+
+    def _fill(self):
+        """Converts the next chunk of rows to csv, returns False if all rows were read."""
+        if self._start >= self.df.shape[0]:
+            return False
+        chunk = self.df.iloc[self._start:self._start + self.chunk_rows]
+        self._start += self.chunk_rows
+        self._buffer = io.StringIO()
+        chunk.to_csv(self._buffer, index=False, header=False)
+        self._buffer.seek(0)
+        return True
+
+    def read(self, size=-1):
+        data = self._buffer.read(size)
+        while (size < 0 or len(data) < size) and self._fill():
+            data += self._buffer.read(size - len(data) if size >= 0 else -1)
+        return data
+
+    def readline(self):
+        line = self._buffer.readline()
+        if not line and self._fill():
+            line = self._buffer.readline()
+        return line
+
+
+def copy_df(cursor, df, table_name):
+    """
+    Copies the rows of df into table_name (columns matched by name) with COPY, streaming from memory.
+
+    :params cursor: psycopg2 cursor
+    :params df: pd DataFrame
+    :params table_name: name of the table
+    """
+    # columns of the schema are not quoted so they are lower case in postgres
+    statement = sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)").format(
+        table=sql.Identifier(table_name),
+        columns=sql.SQL(', ').join([sql.Identifier(col.lower()) for col in df.columns])
+        )
+    cursor.copy_expert(statement, DataFrameCSV(df))
+
 def push_data(df_res, auth, table_name='results'):
     """
     Pushes data to Postgres DB in AWS.
@@ -66,15 +170,58 @@ def push_data(df_res, auth, table_name='results'):
     """
     assert set(df_res.columns) == set(d_COLUMNS[table_name]), 'dataframe columns dont match schema columns'
     assert df_res.shape[0] > 0, 'Dataframe is empty'
-    if not os.path.isdir('data/'):
-        os.mkdir('data')
-    # save in a temporary file 
-    df_res.to_csv('data/temp.csv', index=False)
-    # get cursor and connection 
-    cursor, connection = open_connection(auth)
-    # save results
-    with open('data/temp.csv', 'r') as row:
-        next(row) # skip the header
-        cursor.copy_from(row, table_name, sep=',')
-    # commit connection 
-    connection.commit()
\ No newline at end of file
+    with pooled_connection(auth) as connection:
+        with connection.cursor() as cursor:
+            copy_df(cursor, df_res, table_name)
+
+def create_partition(cursor, table_name, datestr):
+    """
+    Creates the partition of table_name (partitioned by list of datestr) holding datestr if it does not exist.
+
+    :params cursor: psycopg2 cursor
+    :params table_name: name of the partitioned table
+    :params datestr: date string (e.g. 2020-05-01)
+    """
+    partition_name = '{}_{}'.format(table_name, datestr.replace('-', ''))
+    cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES IN (%s)").format(
+        partition=sql.Identifier(partition_name),
+        table=sql.Identifier(table_name)
+        ), (datestr,))
+
+def upsert_data(df_res, auth, table_name='results', key_columns=('id', 'datestr')):
+    """
+    Inserts or updates data in a table partitioned by datestr (see schema_results_partitioned.txt).
+    Rows are copied to a staging table then merged, so pushing the same data twice is idempotent.
+    
+    :params df_res pd: pandas dataframe containing data to be pushed (with a datestr column)
+    :params auth: AWS authentication 
+    :params table_name str: table name (table must exist in database)
+    :params key_columns: columns of the primary key of the table
+    """
+    assert set(df_res.columns) == set(d_COLUMNS[table_name]), 'dataframe columns dont match schema columns'
+    assert df_res.shape[0] > 0, 'Dataframe is empty'
+    staging_name = '{}_staging'.format(table_name)
+    l_columns = [col.lower() for col in df_res.columns]
+    l_update_columns = [col for col in l_columns if col not in key_columns]
+
+    with pooled_connection(auth) as connection:
+        with connection.cursor() as cursor:
+            for datestr in df_res.datestr.unique():
+                create_partition(cursor, table_name, str(datestr))
+
+            cursor.execute(sql.SQL("CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+                staging=sql.Identifier(staging_name),
+                table=sql.Identifier(table_name)
+                ))
+            copy_df(cursor, df_res, staging_name)
+
+            cursor.execute(sql.SQL("""INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}
+                ON CONFLICT ({keys}) DO UPDATE SET {updates}""").format(
+                table=sql.Identifier(table_name),
+                staging=sql.Identifier(staging_name),
+                columns=sql.SQL(', ').join([sql.Identifier(col) for col in l_columns]),
+                keys=sql.SQL(', ').join([sql.Identifier(col) for col in key_columns]),
+                updates=sql.SQL(', ').join([
+                    sql.SQL("{col} = EXCLUDED.{col}").format(col=sql.Identifier(col)) for col in l_update_columns
+                    ])
+                ))
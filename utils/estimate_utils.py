@@ -0,0 +1,94 @@
+import logging
+import threading
+
+import numpy as np
+
+from constants import SCORE_BOUNDS, TRAVEL_MAX_SPEEDS, TRAVEL_ESTIMATE
+from utils.geo_utils import haversine
+
+
+class TravelEstimator(object):
+    def __init__(self,
+                 store=None,
+                 max_speeds=TRAVEL_MAX_SPEEDS,
+                 margin=TRAVEL_ESTIMATE['margin'],
+                 min_samples=TRAVEL_ESTIMATE['min_samples']
+                ):
+        """
+        Local lower bounds of travel times: straight line distance at the maximum speed of the mode.
+        The maximum speed of a mode is calibrated from the results of the travel store (fastest stored result times margin),
+        max_speeds is used for modes with fewer than min_samples stored results.
+
+        :params store: TravelStore of the results used to calibrate speeds (None: max_speeds only)
+        :params max_speeds: dict of maximum speeds (metres per second) by mode
+        :params margin: factor applied to the fastest stored speed
+        :params min_samples: minimum number of stored results to calibrate a mode
+        """
+        self.store = store
+        self.max_speeds = max_speeds
+        self.margin = margin
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._d_speeds = dict()
+
+    def calibrate(self, mode):
+        """Returns the calibrated maximum speed (metres per second) of mode (None if it can't be calibrated)."""
+        if self.store is None:
+            return None
+        samples = self.store.get_samples(mode)
+        # durations are rounded down to the minute, so speeds are over estimated
+        valid = samples['duration'] > 0
+        if valid.sum() < self.min_samples:
+            return None
+        meters = haversine(samples['lat'][valid], samples['lng'][valid], samples['dest_lat'][valid], samples['dest_lng'][valid])
+        return float(np.max(meters / (samples['duration'][valid] * 60))) * self.margin
+
+    def get_max_speed(self, mode):
+        """Returns the maximum speed (metres per second) of mode (calibrated once, None if mode is unknown)."""
+        with self._lock:
+            if mode not in self._d_speeds:
+                speed = self.calibrate(mode)
+                self._d_speeds[mode] = speed if speed is not None else self.max_speeds.get(mode)
+                logging.info({'msg': 'maximum speed of {}: {} m/s ({})'.format(
+                    mode, self._d_speeds[mode], 'calibrated' if speed is not None else 'default')})
+            return self._d_speeds[mode]
+
+    def lower_bounds(self, lat, lng, destination, mode):
+        """
+        Returns lower bounds of the distance (km) and duration (min) from origins to destination using mode.
+
+        :params lat, lng: np arrays of the coordinates of origins
+        :params destination: dict with keys (lat, lng) of destination
+        :params mode: mode of transportation
+        """
+        meters = haversine(lat, lng, destination.get('lat'), destination.get('lng'))
+        return meters / 1000, meters / self.get_max_speed(mode) / 60
+
+    def prune(self, l_origins, destinations, l_modes, score_bounds=SCORE_BOUNDS):
+        """
+        Returns the lower bounds of the travel lookups whose score is 0 whatever the exact result
+        (lower bound of the duration above the max of score_bounds), which don't need to be looked up.
+
+        :params l_origins: list of tuples (lat, lng) of origins
+        :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+        :params l_modes: list of modes of transportation
+
+        :output d_pruned: dict with keys (origin, dest_name, mode) and values (distance, duration) lower bounds
+        """
+        d_pruned = dict()
+        if len(l_origins) == 0:
+            return d_pruned
+        coords = np.array(l_origins, dtype=np.float64).reshape(-1, 2)
+        for mode in l_modes:
+            if mode not in score_bounds or self.get_max_speed(mode) is None:
+                continue
+            for dest_name, dest_lat_lng in destinations.items():
+                dist, duration = self.lower_bounds(coords[:, 0], coords[:, 1], dest_lat_lng, mode)
+                for i in np.flatnonzero(duration >= score_bounds[mode]['max']):
+                    d_pruned[(l_origins[i], dest_name, mode)] = (round(float(dist[i]), 2), round(float(duration[i]), 1))
+
+        logging.info({'msg': 'Number of travel lookups pruned by the local estimator: {n_pruned} out of {n_lookups}'.format(
+            n_pruned=len(d_pruned),
+            n_lookups=len(l_origins) * len(destinations) * len(l_modes)
+        )})
+        return d_pruned
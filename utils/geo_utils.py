@@ -0,0 +1,27 @@
+import numpy as np
+
+# mean earth radius in metres
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Returns the great-circle distance (metres) between points. Works on scalars and np arrays.
+
+    :params lat1, lng1: coordinates (degrees) of the first point(s)
+    :params lat2, lng2: coordinates (degrees) of the second point(s)
+    """
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def meters_to_degrees(meters, lat):
+    """
+    Returns the (lat, lng) offsets in degrees corresponding to meters around latitude lat.
+
+    :params meters: distance in metres
+    :params lat: latitude (degrees) where the offset is measured
+    """
+    dlat = np.degrees(meters / EARTH_RADIUS)
+    dlng = dlat / max(np.cos(np.radians(lat)), 1e-6)
+    return dlat, dlng
@@ -0,0 +1,254 @@
+import json
+import time
+import threading
+import email.utils
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from constants import HTTP_POOL
+
+try:
+    import fcntl
+except ImportError: # not available on windows, the limiter is then only shared between threads
+    fcntl = None
+
+
+# long lived session shared by all outbound calls (see get_session)
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+# counters of the responses of the shared session (see count_response) and of other clients (see count_requests)
+_HTTP_COUNTERS = {'n_requests': 0, 'n_bytes': 0, 'n_bytes_sent': 0, 'n_retries': 0, 'n_errors': 0}
+_HTTP_COUNTERS_LOCK = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    def __init__(self, timeout=None):
+        """
+        Session whose requests use timeout by default.
+
+        :params timeout: default timeout (seconds) or tuple (connect timeout, read timeout)
+        """
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+
+def requests_retry_session(
+    retries=3,
+    backoff_factor=1,
+    status_forcelist=(500, 502, 504),
+    session=None,
+    pool_connections=10,
+    pool_maxsize=10,
+    ):
+    session = session or requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_session():
+    """
+    Returns the keep-alive session shared by all outbound calls (created on first call).
+    Pool size, retries and timeouts are set by HTTP_POOL in constants.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests_retry_session(
+                retries=HTTP_POOL['retries'],
+                backoff_factor=HTTP_POOL['backoff_factor'],
+                session=PooledSession(timeout=HTTP_POOL['timeout']),
+                pool_connections=HTTP_POOL['pool_connections'],
+                pool_maxsize=HTTP_POOL['pool_maxsize'],
+            )
+            _SESSION.hooks['response'].append(count_response)
+        return _SESSION
+
+def count_response(res, *args, **kwargs):
+    """Response hook counting the requests, bytes received and sent, retries (of urllib3) and errors of the shared session."""
+    retries = getattr(res.raw, 'retries', None)
+    n_bytes = len(res.content) if not kwargs.get('stream') else int(res.headers.get('Content-Length') or 0)
+    body = res.request.body if res.request is not None else None
+    count_requests(
+        n_bytes=n_bytes,
+        n_bytes_sent=len(body) if isinstance(body, (bytes, str)) else 0,
+        n_retries=len(retries.history) if retries is not None else 0,
+        n_errors=1 if res.status_code >= 400 else 0
+        )
+
+def count_requests(n_requests=1, n_bytes=0, n_bytes_sent=0, n_retries=0, n_errors=0):
+    """
+    Adds requests to the http counters: responses of the shared session (see count_response) and requests of clients
+    with their own connections (e.g. the Firebase and SendGrid sinks), which count them explicitly.
+
+    :params n_requests: number of requests
+    :params n_bytes: number of bytes received
+    :params n_bytes_sent: number of bytes sent
+    :params n_retries: number of retries
+    :params n_errors: number of failed requests
+    """
+    with _HTTP_COUNTERS_LOCK:
+        _HTTP_COUNTERS['n_requests'] += n_requests
+        _HTTP_COUNTERS['n_bytes'] += n_bytes
+        _HTTP_COUNTERS['n_bytes_sent'] += n_bytes_sent
+        _HTTP_COUNTERS['n_retries'] += n_retries
+        _HTTP_COUNTERS['n_errors'] += n_errors
+
+def get_http_counters():
+    """Returns the number of requests, bytes received and sent, retries and errors counted since the process started."""
+    with _HTTP_COUNTERS_LOCK:
+        return dict(_HTTP_COUNTERS)
+
+def get_session_stats(session=None):
+    """
+    Returns the number of requests and of opened connections of the session.
+    Requests that did not open a connection reused one that was kept alive.
+    """
+    session = session or get_session()
+    n_requests = 0
+    n_connections = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                n_requests += pool.num_requests
+                n_connections += pool.num_connections
+    return {
+        'n_requests': n_requests,
+        'n_connections': n_connections,
+        'n_reused': max(0, n_requests - n_connections)
+    }
+
+
+class RateLimiter(object):
+    def __init__(self, rate, burst=1, state_path=None):
+        """
+        Token bucket rate limiter shared between threads and, if state_path is given, between processes.
+
+        :params rate: number of requests allowed per second
+        :params burst: maximum number of requests that can be sent at once
+        :params state_path: path of the file holding the state of the bucket shared between processes
+        """
+        assert rate > 0, 'rate must be positive'
+        assert burst >= 1, 'burst must be at least 1'
+        self.rate = rate
+        self.burst = burst
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._state = {'tokens': burst, 'updated': time.time(), 'blocked_until': 0}
+
+        # counters
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.n_penalties = 0
+        self.time_throttled = 0.
+
+    @contextmanager
+    def _locked_state(self):
+        """Yields the state of the bucket while holding the thread (and file) lock and saves it afterwards."""
+        with self._lock:
+            if self.state_path is None or fcntl is None:
+                yield self._state
+                return
+
+            with open(self.state_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else dict(self._state)
+                    yield state
+                    # save state for the other processes
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reserve(self):
+        """Takes a token if one is available, otherwise returns the time to wait (seconds) for one."""
+        with self._locked_state() as state:
+            now = time.time()
+            if state['blocked_until'] > now:
+                return state['blocked_until'] - now
+            # refill the bucket
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+            state['updated'] = now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0
+            return (1 - state['tokens']) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a request can be sent.
+
+        :output wait: time (seconds) spent waiting
+        """
+        wait_total = 0.
+        wait = self._reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait_total += wait
+            wait = self._reserve()
+
+        with self._lock:
+            self.n_requests += 1
+            if wait_total > 0:
+                self.n_throttled += 1
+                self.time_throttled += wait_total
+        return wait_total
+
+    def penalize(self, seconds):
+        """Blocks all requests for the next seconds (e.g. when the server asks to retry later)."""
+        with self._locked_state() as state:
+            state['blocked_until'] = max(state['blocked_until'], time.time() + seconds)
+            state['tokens'] = 0
+            state['updated'] = time.time()
+
+        with self._lock:
+            self.n_penalties += 1
+
+    def get_stats(self):
+        """Returns the counters of the limiter."""
+        with self._lock:
+            return {
+                'n_requests': self.n_requests,
+                'n_throttled': self.n_throttled,
+                'n_penalties': self.n_penalties,
+                'time_throttled': round(self.time_throttled, 3)
+            }
+
+
+def get_retry_after(res):
+    """
+    Returns the number of seconds to wait given by the Retry-After header of the response (None if not provided).
+
+    :params res: requests.Response
+    """
+    retry_after = res.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    if retry_after.strip().isnumeric():
+        return float(retry_after)
+    # Retry-After can also be a http date
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+        return max(0., retry_date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,236 @@
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+from constants import ISOCHRONE_DIR, AREA_BBOXES, ISOCHRONE_PARAMS, SCORE_BOUNDS, TRAVEL_MAX_WORKERS
+from utils.geo_utils import meters_to_degrees
+from utils.base_utils import get_travel_matrix
+
+# grids loaded in this process: path -> (modification time, IsochroneGrid)
+_GRIDS = dict()
+_GRIDS_LOCK = threading.Lock()
+
+
+def get_area_bbox(site, area=None):
+    """Returns the bounding box [lat_min, lng_min, lat_max, lng_max] of the crawl area (None if it is not in AREA_BBOXES)."""
+    return AREA_BBOXES.get(site, {}).get(area)
+
+def get_grid_path(site, area=None, grid_dir=ISOCHRONE_DIR):
+    """Returns the path of the isochrone grid of the crawl area."""
+    return os.path.join(grid_dir, '{}_{}.npz'.format(site, area or 'all'))
+
+def build_grid_axes(bbox, step):
+    """
+    Returns the coordinates of a grid covering bbox.
+
+    :params bbox: list [lat_min, lng_min, lat_max, lng_max]
+    :params step: distance (metres) between two nodes of the grid
+
+    :output lat, lng: np arrays of the coordinates (rounded to 6 decimals) of the rows and columns of the grid
+    """
+    lat_min, lng_min, lat_max, lng_max = bbox
+    dlat, dlng = meters_to_degrees(step, (lat_min + lat_max) / 2)
+    lat = lat_min + dlat * np.arange(int(np.ceil((lat_max - lat_min) / dlat)) + 1)
+    lng = lng_min + dlng * np.arange(int(np.ceil((lng_max - lng_min) / dlng)) + 1)
+    return np.round(lat, 6), np.round(lng, 6)
+
+def interpolation_weights(axis, values):
+    """
+    Returns the index of the lower node of the cell of each value along axis and the weight of the upper node.
+
+    :params axis: increasing np array of the coordinates of the grid
+    :params values: np array of coordinates
+
+    :output index, weight, inside: np arrays (inside is False for values outside of axis)
+    """
+    inside = (values >= axis[0]) & (values <= axis[-1])
+    index = np.clip(np.searchsorted(axis, values, side='right') - 1, 0, len(axis) - 2)
+    weight = (values - axis[index]) / (axis[index + 1] - axis[index])
+    return index, weight, inside
+
+
+class IsochroneGrid(object):
+    def __init__(self, lat, lng, destinations, l_modes, distance, duration, created=None):
+        """
+        Distances and durations from the nodes of a grid to destinations using modes, answering travel lookups of
+        listings inside the grid by bilinear interpolation.
+
+        :params lat, lng: increasing np arrays of the coordinates of the rows and columns of the grid
+        :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+        :params l_modes: list of modes of transportation
+        :params distance, duration: np arrays (destinations x modes x lat x lng) of distances (km) and durations (min),
+        nan for nodes without result
+        :params created: timestamp of the results (default: now)
+        """
+        self.lat = lat
+        self.lng = lng
+        self.destinations = destinations
+        self.l_modes = list(l_modes)
+        self.distance = distance
+        self.duration = duration
+        self.created = time.time() if created is None else created
+
+    @classmethod
+    def fetch(cls, bbox, destinations, l_modes, step=ISOCHRONE_PARAMS['step'], max_workers=TRAVEL_MAX_WORKERS):
+        """
+        Returns the grid of bbox with travel data pulled with batched requests (see get_travel_matrix).
+
+        :params bbox: list [lat_min, lng_min, lat_max, lng_max]
+        :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+        :params l_modes: list of modes of transportation
+        :params step: distance (metres) between two nodes of the grid
+        :params max_workers: maximum number of concurrent requests
+        """
+        lat, lng = build_grid_axes(bbox, step)
+        l_nodes = [(x, y) for x in lat.tolist() for y in lng.tolist()]
+        logging.info({'msg': 'pulling travel data of a grid of {} nodes to {} using {}'.format(
+            len(l_nodes), list(destinations.keys()), l_modes)})
+        d_travel = get_travel_matrix(l_nodes, destinations=destinations, l_modes=l_modes, max_workers=max_workers)
+
+        arr = np.array([
+            [[d_travel[(node, dest_name, mode)] for node in l_nodes] for mode in l_modes] for dest_name in destinations
+            ], dtype=np.float32).reshape(len(destinations), len(l_modes), len(lat), len(lng), 2)
+        return cls(lat, lng, destinations, l_modes, distance=arr[..., 0], duration=arr[..., 1])
+
+    def save(self, path):
+        """Saves the grid as a compressed npz file."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        l_dest_names = list(self.destinations.keys())
+        # write then rename so that a crawl never loads a partial file
+        path_tmp = path + '.tmp'
+        with open(path_tmp, 'wb') as f:
+            np.savez_compressed(
+                f,
+                lat=self.lat,
+                lng=self.lng,
+                dest_names=np.array(l_dest_names),
+                dest_coords=np.array([[self.destinations[name]['lat'], self.destinations[name]['lng']] for name in l_dest_names]),
+                modes=np.array(self.l_modes),
+                distance=self.distance,
+                duration=self.duration,
+                created=self.created
+                )
+        os.replace(path_tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a grid saved with save."""
+        with np.load(path) as data:
+            destinations = {
+                str(name): {'lat': float(lat), 'lng': float(lng)} for name, (lat, lng) in zip(data['dest_names'], data['dest_coords'])
+            }
+            return cls(data['lat'], data['lng'], destinations, [str(mode) for mode in data['modes']],
+                       distance=data['distance'], duration=data['duration'], created=float(data['created']))
+
+    def is_stale(self, ttl=ISOCHRONE_PARAMS['ttl']):
+        """Returns True if the results of the grid are older than ttl days."""
+        return time.time() - self.created > ttl * 86400
+
+    def get_layer(self, dest_name, dest_lat_lng, mode):
+        """Returns the (destination, mode) indices of the results of the grid (None if dest_name moved or is missing)."""
+        if dest_name not in self.destinations or mode not in self.l_modes:
+            return None
+        grid_lat_lng = self.destinations[dest_name]
+        if not np.allclose([grid_lat_lng['lat'], grid_lat_lng['lng']], [dest_lat_lng['lat'], dest_lat_lng['lng']], atol=1e-6):
+            return None
+        return list(self.destinations.keys()).index(dest_name), self.l_modes.index(mode)
+
+    def covers(self, destinations, l_modes):
+        """Returns True if the grid has results for all destinations and modes."""
+        return all([
+            self.get_layer(dest_name, dest_lat_lng, mode) is not None
+            for dest_name, dest_lat_lng in destinations.items() for mode in l_modes
+        ])
+
+    def lookup(self, l_origins, destinations, l_modes, accuracy=ISOCHRONE_PARAMS['accuracy'], score_bounds=SCORE_BOUNDS):
+        """
+        Returns the travel lookups of l_origins answered by interpolation of the grid. A lookup is answered when its
+        origin is inside the grid, the 4 nodes of its cell have results and either they are all at least accuracy
+        below the min or above the max of the score bounds of the mode (the score is the same) or their durations
+        differ by at most accuracy and are at least accuracy away from the score bounds.
+
+        :params l_origins: list of tuples (lat, lng) of origins
+        :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+        :params l_modes: list of modes of transportation
+        :params accuracy: accuracy (minutes) of interpolated durations
+        :params score_bounds: dict of the bounds of scores by mode
+
+        :output d_known: dict with keys (origin, dest_name, mode) and values (distance, duration)
+        """
+        d_known = dict()
+        if len(l_origins) == 0:
+            return d_known
+        coords = np.array(l_origins, dtype=np.float64).reshape(-1, 2)
+        i, wi, inside_lat = interpolation_weights(self.lat, coords[:, 0])
+        j, wj, inside_lng = interpolation_weights(self.lng, coords[:, 1])
+        l_weights = [(1 - wi) * (1 - wj), (1 - wi) * wj, wi * (1 - wj), wi * wj]
+
+        for dest_name, dest_lat_lng in destinations.items():
+            for mode in l_modes:
+                layer = self.get_layer(dest_name, dest_lat_lng, mode)
+                if layer is None:
+                    continue
+                duration = self.duration[layer].astype(np.float64)
+                distance = self.distance[layer].astype(np.float64)
+                l_nodes = [(i, j), (i, j + 1), (i + 1, j), (i + 1, j + 1)]
+                corners = np.column_stack([duration[node] for node in l_nodes])
+                lo, hi = corners.min(axis=1), corners.max(axis=1)
+
+                # nan corners (no result or outside the grid) compare False
+                answered = inside_lat & inside_lng & np.isfinite(corners).all(axis=1)
+                if mode in score_bounds:
+                    min_bound, max_bound = score_bounds[mode]['min'], score_bounds[mode]['max']
+                    same_score = (hi <= min_bound - accuracy) | (lo >= max_bound + accuracy)
+                    near_bounds = ((lo - accuracy < min_bound) & (hi + accuracy > min_bound)) | \
+                        ((lo - accuracy < max_bound) & (hi + accuracy > max_bound))
+                    answered &= same_score | ((hi - lo <= accuracy) & ~near_bounds)
+                else:
+                    answered &= hi - lo <= accuracy
+
+                arr_dist = sum([w * distance[node] for w, node in zip(l_weights, l_nodes)])
+                arr_dur = sum([w * corners[:, n] for n, w in enumerate(l_weights)])
+                for k in np.flatnonzero(answered):
+                    d_known[(l_origins[k], dest_name, mode)] = (round(float(arr_dist[k]), 2), round(float(arr_dur[k]), 1))
+
+        logging.info({'msg': 'Number of travel lookups answered by the isochrone grid: {n_known} out of {n_lookups}'.format(
+            n_known=len(d_known),
+            n_lookups=len(l_origins) * len(destinations) * len(l_modes)
+        )})
+        return d_known
+
+
+def get_isochrone_grid(site, area=None, ttl=ISOCHRONE_PARAMS['ttl'], grid_dir=ISOCHRONE_DIR):
+    """
+    Returns the isochrone grid of the crawl area, loaded once per process (reloaded when the file changes).
+    Returns None if the grid was not built or is older than ttl days.
+    """
+    path = get_grid_path(site, area, grid_dir=grid_dir)
+    with _GRIDS_LOCK:
+        if not os.path.exists(path):
+            return None
+        mtime = os.path.getmtime(path)
+        if path not in _GRIDS or _GRIDS[path][0] != mtime:
+            _GRIDS[path] = (mtime, IsochroneGrid.load(path))
+        grid = _GRIDS[path][1]
+    if grid.is_stale(ttl):
+        logging.warning({'msg': 'isochrone grid {} is older than {} days, it is not used'.format(path, ttl)})
+        return None
+    return grid
+
+def build_isochrone_grid(site, area, destinations, l_modes, step=ISOCHRONE_PARAMS['step'], grid_dir=ISOCHRONE_DIR):
+    """
+    Pulls and saves the isochrone grid of the crawl area (its bounding box is in AREA_BBOXES).
+
+    :params site, area: crawl area
+    :params destinations: dict with names of destinations as keys and dicts with keys (lat, lng) as values
+    :params l_modes: list of modes of transportation
+    :params step: distance (metres) between two nodes of the grid
+    """
+    bbox = get_area_bbox(site, area)
+    assert bbox is not None, 'No bounding box for site {} and area {}, please add it to AREA_BBOXES'.format(site, area)
+    grid = IsochroneGrid.fetch(bbox, destinations, l_modes, step=step)
+    grid.save(get_grid_path(site, area, grid_dir=grid_dir))
+    return grid
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import logging
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager
+
+from constants import METRICS_DIR
+from utils.http_utils import get_http_counters
+
+# counters of http_utils.get_http_counters reported for each stage
+HTTP_COUNTERS = ['n_requests', 'n_bytes', 'n_bytes_sent', 'n_retries', 'n_errors']
+
+
+class RunMetrics(object):
+    def __init__(self, caches=None, profile_stage=None, profile_dir=METRICS_DIR):
+        """
+        Measures of the stages of a run: wall time, rows, requests, bytes received and sent, retries and errors (of the
+        shared http session and of the clients counting their requests, see http_utils.count_requests) and hits and
+        misses of caches. Stages run concurrently share the http counters.
+
+        :params caches: dict {name: cache}, caches have a get_stats method returning n_hits and n_misses
+        :params profile_stage: name of the stage profiled with cProfile (profiles only the thread running the stage)
+        :params profile_dir: directory of the profiles
+        """
+        self.caches = dict(caches or {})
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.started = time.time()
+        self.l_stages = []
+        self._lock = threading.Lock()
+
+    def add_caches(self, caches):
+        """Adds caches (dict {name: cache}) whose hits and misses are reported."""
+        self.caches.update(caches)
+
+    def _snapshot(self):
+        return {
+            'http': get_http_counters(),
+            'caches': {name: cache.get_stats() for name, cache in self.caches.items()}
+        }
+
+    @staticmethod
+    def _diff(before, after):
+        d_caches = dict()
+        for name, stats in after['caches'].items():
+            stats_before = before['caches'].get(name, {})
+            d_caches[name] = {
+                key: stats[key] - stats_before.get(key, 0) for key in ['n_hits', 'n_misses']
+            }
+        d_http = {key: after['http'][key] - before['http'][key] for key in HTTP_COUNTERS}
+        return d_http, d_caches
+
+    @contextmanager
+    def stage(self, name, count_http=True, **labels):
+        """
+        Measures the block as a stage. Yields the record of the stage, the block can set its "rows".
+
+        :params name: name of the stage (e.g. pull_data, sink_firebase)
+        :params count_http: report the http counters of the stage, False if some of its requests are not counted
+        (e.g. the search pages requested by python-craigslist), its "http" is then None
+        :params labels: labels of the stage (e.g. site, area)
+        """
+        record = {'stage': name, 'labels': labels, 'rows': None, 'status': 'ok'}
+        before = self._snapshot()
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        except Exception:
+            record['status'] = 'error'
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record['profile'] = os.path.join(self.profile_dir, '{}_{}.prof'.format(name, len(self.l_stages)))
+                profiler.dump_stats(record['profile'])
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['http'], record['caches'] = self._diff(before, self._snapshot())
+            if not count_http:
+                record['http'] = None
+            with self._lock:
+                self.l_stages.append(record)
+            logging.info({'msg': 'stage metrics', 'metrics': record})
+
+    def to_dict(self):
+        """Returns the report of the run."""
+        with self._lock:
+            l_stages = list(self.l_stages)
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+            'seconds': round(time.time() - self.started, 4),
+            'stages': l_stages
+        }
+
+    @staticmethod
+    def _write(path, content):
+        # write then rename so that readers (e.g. the node exporter) never see a partial file
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        path_tmp = path + '.tmp'
+        with open(path_tmp, 'w') as f:
+            f.write(content)
+        os.replace(path_tmp, path)
+
+    def write_json(self, path):
+        """Writes the report of the run as json."""
+        self._write(path, json.dumps(self.to_dict(), indent=2, default=str))
+
+    def to_prometheus(self, prefix='craig'):
+        """
+        Returns the report of the run in the Prometheus text format.
+        Stages with the same name and labels (e.g. score of several filters) are summed, the http metrics of stages whose
+        requests are not all counted are left out.
+        """
+        d_report = self.to_dict()
+        d_metrics = {
+            'stage_duration_seconds': ('Wall time of the stage', dict()),
+            'stage_rows': ('Number of rows processed by the stage', dict()),
+            'stage_failures': ('Number of times the stage raised an error', dict()),
+            'stage_http_requests': ('Number of http requests sent during the stage', dict()),
+            'stage_http_bytes': ('Number of bytes received during the stage', dict()),
+            'stage_http_bytes_sent': ('Number of bytes sent during the stage', dict()),
+            'stage_http_retries': ('Number of http retries during the stage', dict()),
+            'stage_http_errors': ('Number of http error responses during the stage', dict()),
+            'stage_cache_hits': ('Number of cache hits during the stage', dict()),
+            'stage_cache_misses': ('Number of cache misses during the stage', dict()),
+        }
+
+        def add(metric, labels, value):
+            key = tuple(sorted(labels.items()))
+            d_values = d_metrics[metric][1]
+            d_values[key] = d_values.get(key, 0) + (value or 0)
+
+        for record in d_report['stages']:
+            labels = dict(record['labels'], stage=record['stage'])
+            add('stage_duration_seconds', labels, record['seconds'])
+            add('stage_rows', labels, record['rows'])
+            add('stage_failures', labels, int(record['status'] != 'ok'))
+            for key in HTTP_COUNTERS if record['http'] is not None else []:
+                add('stage_http_{}'.format(key[len('n_'):]), labels, record['http'][key])
+            for name, stats in record['caches'].items():
+                add('stage_cache_hits', dict(labels, cache=name), stats['n_hits'])
+                add('stage_cache_misses', dict(labels, cache=name), stats['n_misses'])
+
+        def format_labels(key):
+            return ','.join(['{}="{}"'.format(
+                name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                ) for name, value in key])
+
+        lines = []
+        for metric, (help_, d_values) in d_metrics.items():
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, help_))
+            lines.append('# TYPE {}_{} gauge'.format(prefix, metric))
+            for key, value in d_values.items():
+                lines.append('{}_{}{{{}}} {}'.format(prefix, metric, format_labels(key), value))
+        for metric, help_, value in [
+            ('run_start_timestamp_seconds', 'Start time of the run', round(self.started, 3)),
+            ('run_duration_seconds', 'Wall time of the run', d_report['seconds'])
+        ]:
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, help_))
+            lines.append('# TYPE {}_{} gauge'.format(prefix, metric))
+            lines.append('{}_{} {}'.format(prefix, metric, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='craig'):
+        """Writes the report of the run as a Prometheus textfile (for the textfile collector of the node exporter)."""
+        self._write(path, self.to_prometheus(prefix=prefix))
@@ -0,0 +1,85 @@
+import pandas as pd
+
+
+def get_max_bedrooms(filter_):
+    """Returns the max number of bedrooms of a filter (min_bedrooms if not provided)."""
+    max_bedrooms = filter_.get('max_bedrooms')
+    return max_bedrooms if max_bedrooms is not None else filter_['min_bedrooms']
+
+def superset_filter(l_filters):
+    """
+    Returns the filter whose results contain the results of all filters (same site and area).
+
+    :params l_filters: list of filters dicts (as in input.json)
+    """
+    assert len(set((f['site'], f['area']) for f in l_filters)) == 1, 'all filters must have the same site and area'
+    return {
+        'title': ' + '.join([str(f.get('title')) for f in l_filters]),
+        'site': l_filters[0]['site'],
+        'area': l_filters[0]['area'],
+        'price_min': min([f['price_min'] for f in l_filters]),
+        'price_max': max([f['price_max'] for f in l_filters]),
+        'min_bedrooms': min([f['min_bedrooms'] for f in l_filters]),
+        'max_bedrooms': max([get_max_bedrooms(f) for f in l_filters]),
+        'min_ft2': min([f['min_ft2'] for f in l_filters]),
+    }
+
+def filters_mergeable(filter_1, filter_2):
+    """
+    Returns True if two filters can be crawled together: same site and area, overlapping price ranges and
+    overlapping or adjacent bedrooms ranges (e.g. 2 and 3 bedrooms), so that their superset filter only adds the
+    listings of their price overlap with the other number of bedrooms.
+    """
+    return (
+        (filter_1['site'], filter_1['area']) == (filter_2['site'], filter_2['area'])
+        and filter_1['price_min'] <= filter_2['price_max'] and filter_2['price_min'] <= filter_1['price_max']
+        and filter_1['min_bedrooms'] <= get_max_bedrooms(filter_2) + 1
+        and filter_2['min_bedrooms'] <= get_max_bedrooms(filter_1) + 1
+    )
+
+def plan_crawls(l_filters):
+    """
+    Groups mergeable filters (see filters_mergeable, transitively) so that each group is crawled once with its
+    superset filter. Filters with disjoint price ranges or distant bedrooms (e.g. 1 and 3 bedrooms) are crawled
+    separately: their superset would mostly crawl listings matching none of them. Separate crawls still share
+    travel data (see TRAVEL_STORE).
+
+    :params l_filters: list of filters dicts (as in input.json)
+
+    :output l_plans: list of dicts with keys "filters" (superset filter) and "members" (list of (index, filter))
+    """
+    # groups of mergeable filters (transitively), by index of their first filter
+    l_groups = list(range(len(l_filters)))
+    for i in range(len(l_filters)):
+        for j in range(i):
+            if l_groups[i] != l_groups[j] and filters_mergeable(l_filters[i], l_filters[j]):
+                group_old, group_new = max(l_groups[i], l_groups[j]), min(l_groups[i], l_groups[j])
+                l_groups = [group_new if group == group_old else group for group in l_groups]
+
+    d_groups = dict()
+    for i, filter_ in enumerate(l_filters):
+        d_groups.setdefault(l_groups[i], []).append((i, filter_))
+
+    l_plans = []
+    for l_members in d_groups.values():
+        l_plans.append({
+            'filters': superset_filter([filter_ for _, filter_ in l_members]),
+            'members': l_members
+        })
+    return l_plans
+
+def filter_mask(df_res, filter_):
+    """
+    Returns the boolean mask of listings of df_res matching the price, bedrooms and area bounds of filter_.
+    Listings without bedrooms are kept, as craigslist does for the bedrooms filter of a search.
+
+    :params df_res: pd DataFrame with columns ["price", "bedrooms", "area"]
+    :params filter_: filter dict (as in input.json)
+    """
+    bedrooms = pd.to_numeric(df_res.bedrooms, errors='coerce')
+    mask = (
+        df_res.price.between(filter_['price_min'], filter_['price_max'])
+        & (bedrooms.between(filter_['min_bedrooms'], get_max_bedrooms(filter_)) | bedrooms.isna())
+        & (df_res.area >= filter_['min_ft2'])
+    )
+    return mask
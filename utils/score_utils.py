@@ -0,0 +1,64 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from constants import SCORE_BOUNDS
+
+
+def normalize_array(values, min_bound, max_bound, missing=1.):
+    """
+    Vectorized version of HousingCrawler.normalize_val: gets normalized values [0, 1]. (1: is good and 0 is bad)
+    Missing values get a score of missing (1 by default, as normalize_val does: min(1, nan) returns 1).
+
+    :params values: array-like of values you want to normalize
+    :params min_bound: the minimum value (if val <= min_val then score = 1)
+    :params max_bound: the maximum value (if val >= max_val then score = 0)
+    :params missing: score of missing values
+
+    :output norm_values: np array of values between [0, 1]
+    """
+    values = np.asarray(pd.to_numeric(values, errors='coerce'), dtype=np.float64)
+    # get raw normalized values
+    raw_norm_scores = 1 - (values - min_bound) / (max_bound - min_bound)
+    # set bounds between 0 and 1
+    normalized_scores = np.clip(raw_norm_scores, 0, 1)
+    normalized_scores[np.isnan(raw_norm_scores)] = missing
+    return normalized_scores
+
+def column_score(values, val_name, missing=1.):
+    """
+    Gets the scores of values using the bounds of val_name in SCORE_BOUNDS.
+
+    :params values: array-like of values
+    :params val_name: key of SCORE_BOUNDS (e.g. ppsqft, walking)
+    :params missing: score of missing values
+    """
+    min_val = SCORE_BOUNDS.get(val_name).get('min')
+    max_val = SCORE_BOUNDS.get(val_name).get('max')
+    return normalize_array(values, min_bound=min_val, max_bound=max_val, missing=missing)
+
+def max_score(l_scores):
+    """
+    Gets the max of several score arrays element-wise (e.g. travel score is the max of all mode scores).
+
+    :params l_scores: list of np arrays of the same length
+    """
+    return np.max(np.column_stack(l_scores), axis=1)
+
+def geometric_mean_array(scores):
+    """
+    Vectorized version of geometric_mean: geometric mean of each row of scores (0 if any score is 0).
+    Missing scores are ignored.
+
+    :params scores: 2d array-like (rows x scores)
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    has_zero = (scores == 0).any(axis=1)
+    # rows with a 0 are overwritten below
+    log_scores = np.log(np.where(scores == 0, 1., scores))
+    with warnings.catch_warnings():
+        # rows with only missing scores give nan
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        gmean = np.exp(np.nanmean(log_scores, axis=1))
+    return np.where(has_zero, 0., gmean)
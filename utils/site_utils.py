@@ -0,0 +1,134 @@
+import os
+import json
+import pickle
+import logging
+import threading
+from urllib.parse import urlparse
+
+from constants import PATH_CITIES, SITE_INDEX_PATH
+
+
+# version of the index format, indexes of other versions are rebuilt
+SITE_INDEX_VERSION = 2
+# index loaded on first use (see get_site_index)
+_SITE_INDEX = None
+_SITE_INDEX_LOCK = threading.Lock()
+
+
+def get_site_code(url):
+    """Returns the site code of a craigslist url (e.g. https://sfbay.craigslist.org/ -> sfbay)."""
+    return urlparse(url).netloc.split('.')[0]
+
+def get_area_code(url):
+    """
+    Returns the area code of a craigslist area url, None for the url of a site.
+    Area urls of cities.json may be nested in the url of another area (e.g. http://miami.craigslist.org/brw//mdc/ -> mdc).
+    """
+    l_segments = [segment for segment in urlparse(url).path.split('/') if segment]
+    return l_segments[-1] if l_segments else None
+
+def get_area_url(url):
+    """Returns the normalized url of a craigslist area url (e.g. http://miami.craigslist.org/brw//mdc/ -> http://miami.craigslist.org/mdc/)."""
+    parsed = urlparse(url)
+    return '{}://{}/{}/'.format(parsed.scheme, parsed.netloc, get_area_code(url))
+
+def build_site_index(d_cities):
+    """
+    Builds the index of sites and areas from the nested dict of cities.json (state -> city -> area -> url).
+    Cities of the same site (e.g. the areas of south florida are also listed as cities) are merged into one site
+    holding the areas of all of them, described by the city whose url is the url of the site.
+
+    :params d_cities: dict of cities (see scripts/get_cities.py)
+
+    :output d_index: dict with keys
+        "sites": {site: {"state", "city", "url", "areas": {area: {"name", "url"}}}}
+        "area_sites": {area: list of sites having that area}
+        "city_sites": {city: site}
+    """
+    d_sites = dict()
+    d_city_sites = dict()
+    for state, d_state in d_cities.items():
+        for city, d_city in d_state.items():
+            url = d_city['general']
+            site = get_site_code(url)
+            d_site = d_sites.setdefault(site, {'state': state, 'city': city, 'url': url, 'areas': dict()})
+            if get_area_code(url) is None:
+                d_site.update({'state': state, 'city': city, 'url': url})
+            else:
+                # the city is an area of the site
+                d_site['areas'].setdefault(get_area_code(url), {'name': city, 'url': get_area_url(url)})
+            for name, area_url in d_city.items():
+                if name == 'general' or get_area_code(area_url) is None:
+                    continue
+                d_site['areas'].setdefault(get_area_code(area_url), {'name': name, 'url': get_area_url(area_url)})
+            d_city_sites[city] = site
+
+    d_area_sites = dict()
+    for site, d_site in d_sites.items():
+        for area in d_site['areas']:
+            d_area_sites.setdefault(area, []).append(site)
+    return {'version': SITE_INDEX_VERSION, 'sites': d_sites, 'area_sites': d_area_sites, 'city_sites': d_city_sites}
+
+def load_site_index(path_cities=PATH_CITIES, path_index=SITE_INDEX_PATH):
+    """
+    Loads the compiled index, which is (re)built from path_cities if it is missing, older than path_cities or of
+    another version.
+    Returns None if path_cities does not exist.
+    """
+    if not os.path.exists(path_cities):
+        logging.warning({'msg': '{} not found, sites and areas are not validated'.format(path_cities)})
+        return None
+    if os.path.exists(path_index) and os.path.getmtime(path_index) >= os.path.getmtime(path_cities):
+        with open(path_index, 'rb') as f:
+            d_index = pickle.load(f)
+        if d_index.get('version') == SITE_INDEX_VERSION:
+            return d_index
+
+    with open(path_cities) as f:
+        d_index = build_site_index(json.load(f))
+    os.makedirs(os.path.dirname(path_index) or '.', exist_ok=True)
+    path_tmp = path_index + '.tmp'
+    with open(path_tmp, 'wb') as f:
+        pickle.dump(d_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path_tmp, path_index)
+    logging.info({'msg': 'site index built from {}: {} sites'.format(path_cities, len(d_index['sites']))})
+    return d_index
+
+def get_site_index():
+    """Returns the index of sites and areas (loaded on first call, see load_site_index)."""
+    global _SITE_INDEX
+    with _SITE_INDEX_LOCK:
+        if _SITE_INDEX is None:
+            _SITE_INDEX = load_site_index()
+        return _SITE_INDEX
+
+def get_areas(site):
+    """Returns the dict of areas of site ({area: {"name", "url"}}), None if the site does not exist."""
+    d_site = get_site_index()['sites'].get(site)
+    return d_site['areas'] if d_site is not None else None
+
+def get_area_sites(area):
+    """Returns the list of sites having area."""
+    return get_site_index()['area_sites'].get(area, [])
+
+def get_city_site(city):
+    """Returns the site of a city (e.g. san francisco bay area -> sfbay), None if the city does not exist."""
+    return get_site_index()['city_sites'].get(city)
+
+def validate_site_area(site, area=None):
+    """
+    Asserts that site exists and that area (if given) is an area of site.
+    Nothing is checked if the index could not be loaded.
+    """
+    d_index = get_site_index()
+    if d_index is None:
+        return
+    assert site in d_index['sites'], 'site {} does not exist'.format(site)
+    if area is not None:
+        d_areas = d_index['sites'][site]['areas']
+        assert area in d_areas, 'area {area} does not exist in site {site} (areas: {areas}{hint})'.format(
+            area=area,
+            site=site,
+            areas=sorted(d_areas.keys()),
+            hint=', sites with this area: {}'.format(d_index['area_sites'][area]) if area in d_index['area_sites'] else ''
+        )
@@ -0,0 +1,180 @@
+import time
+import sqlite3
+import threading
+
+import numpy as np
+
+from constants import LATLNG_KEY_SCALE
+from utils.geo_utils import haversine, meters_to_degrees
+
+
+class TravelStore(object):
+    # number of writes between two purges of expired results
+    PURGE_PERIOD = 1000
+
+    def __init__(self, path, tolerance=50, ttl=30, key_scale=LATLNG_KEY_SCALE):
+        """
+        Persistent travel-time store (SQLite with an R-tree index on origins).
+        A lookup returns the closest stored result within tolerance of the origin for the same destination and mode.
+        Results of the same destination, mode and rounded origin (see LATLNG_KEY_SCALE) replace each other and
+        expired results are purged periodically.
+
+        :params path: path of the SQLite database
+        :params tolerance: maximum distance (metres) between the origin and a stored origin to reuse its result
+        :params ttl: number of days a stored result is valid
+        :params key_scale: scale of the rounded origins (rint(lat * key_scale))
+        """
+        self.path = path
+        self.tolerance = tolerance
+        self.ttl = ttl
+        self.key_scale = key_scale
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._n_writes = 0
+
+        # counters
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _connect(self):
+        """Returns the connection of the current thread (created and initialized on first call)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            with self._lock:
+                if not self._initialized:
+                    self._create_tables(connection)
+                    self._initialized = True
+            self._local.connection = connection
+        return connection
+
+    def _create_tables(self, connection):
+        connection.execute("""CREATE TABLE IF NOT EXISTS travel(
+            id INTEGER PRIMARY KEY,
+            dest_lat REAL,
+            dest_lng REAL,
+            mode TEXT,
+            lat REAL,
+            lng REAL,
+            distance REAL,
+            duration REAL,
+            created REAL,
+            lat_key INTEGER,
+            lng_key INTEGER)""")
+        connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS travel_index
+            USING rtree(id, min_lat, max_lat, min_lng, max_lng)""")
+        l_columns = [row[1] for row in connection.execute("PRAGMA table_info(travel)").fetchall()]
+        if 'lat_key' not in l_columns:
+            # stores created without rounded origins: add them and keep the latest result of each key
+            connection.execute("ALTER TABLE travel ADD COLUMN lat_key INTEGER")
+            connection.execute("ALTER TABLE travel ADD COLUMN lng_key INTEGER")
+            connection.execute(
+                "UPDATE travel SET lat_key = CAST(ROUND(lat * ?) AS INTEGER), lng_key = CAST(ROUND(lng * ?) AS INTEGER)",
+                (self.key_scale, self.key_scale)
+                )
+            connection.execute("""DELETE FROM travel WHERE id NOT IN (
+                SELECT MAX(id) FROM travel GROUP BY dest_lat, dest_lng, mode, lat_key, lng_key)""")
+            connection.execute("DELETE FROM travel_index WHERE id NOT IN (SELECT id FROM travel)")
+        connection.execute("""CREATE UNIQUE INDEX IF NOT EXISTS travel_key
+            ON travel(dest_lat, dest_lng, mode, lat_key, lng_key)""")
+        connection.commit()
+
+    def get(self, origin, destination, mode):
+        """
+        Returns the (distance, duration) stored for the closest origin within tolerance (None if there are none).
+
+        :params origin: tuple (lat, lng) of origin
+        :params destination: dict with keys (lat, lng) of destination
+        :params mode: mode of transportation
+        """
+        lat, lng = origin
+        dlat, dlng = meters_to_degrees(self.tolerance, lat)
+        rows = self._connect().execute("""SELECT t.lat, t.lng, t.distance, t.duration
+            FROM travel_index i JOIN travel t ON t.id = i.id
+            WHERE i.min_lat <= ? AND i.max_lat >= ? AND i.min_lng <= ? AND i.max_lng >= ?
+            AND t.dest_lat = ? AND t.dest_lng = ? AND t.mode = ? AND t.created >= ?""",
+            (lat + dlat, lat - dlat, lng + dlng, lng - dlng,
+             destination.get('lat'), destination.get('lng'), mode, time.time() - self.ttl * 86400)
+            ).fetchall()
+
+        best = None
+        best_dist = self.tolerance
+        for row_lat, row_lng, distance, duration in rows:
+            dist = haversine(lat, lng, row_lat, row_lng)
+            if dist <= best_dist:
+                best, best_dist = (distance, duration), dist
+
+        with self._lock:
+            if best is None:
+                self.n_misses += 1
+            else:
+                self.n_hits += 1
+        return best
+
+    def put_many(self, l_records):
+        """
+        Stores travel results.
+
+        :params l_records: list of tuples (origin, destination, mode, distance, duration)
+        """
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            for origin, destination, mode, distance, duration in l_records:
+                key = (destination.get('lat'), destination.get('lng'), mode,
+                       int(round(origin[0] * self.key_scale)), int(round(origin[1] * self.key_scale)))
+                # a result of the same rounded origin is replaced (its id, and so its index entry, is kept)
+                connection.execute("""INSERT INTO travel(dest_lat, dest_lng, mode, lat_key, lng_key, lat, lng, distance, duration, created)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(dest_lat, dest_lng, mode, lat_key, lng_key) DO UPDATE SET
+                    lat = excluded.lat, lng = excluded.lng, distance = excluded.distance,
+                    duration = excluded.duration, created = excluded.created""",
+                    key + (origin[0], origin[1], distance, duration, now)
+                    )
+                row_id = connection.execute(
+                    "SELECT id FROM travel WHERE dest_lat = ? AND dest_lng = ? AND mode = ? AND lat_key = ? AND lng_key = ?", key
+                    ).fetchone()[0]
+                connection.execute(
+                    "INSERT OR REPLACE INTO travel_index(id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+                    (row_id, origin[0], origin[0], origin[1], origin[1])
+                    )
+        with self._lock:
+            n_writes_before = self._n_writes
+            self._n_writes += len(l_records)
+            purge = self._n_writes // self.PURGE_PERIOD != n_writes_before // self.PURGE_PERIOD
+        if purge:
+            self.purge()
+
+    def purge(self):
+        """Deletes the expired results (older than ttl days)."""
+        connection = self._connect()
+        with connection:
+            expired = time.time() - self.ttl * 86400
+            connection.execute("DELETE FROM travel_index WHERE id IN (SELECT id FROM travel WHERE created < ?)", (expired,))
+            n_purged = connection.execute("DELETE FROM travel WHERE created < ?", (expired,)).rowcount
+        return n_purged
+
+    def get_samples(self, mode):
+        """
+        Returns the valid stored results of mode as arrays (used to calibrate travel time estimates).
+
+        :output samples: dict of np arrays with keys lat, lng, dest_lat, dest_lng, duration (minutes)
+        """
+        rows = self._connect().execute(
+            "SELECT lat, lng, dest_lat, dest_lng, duration FROM travel WHERE mode = ? AND duration IS NOT NULL AND created >= ?",
+            (mode, time.time() - self.ttl * 86400)
+            ).fetchall()
+        arr = np.array(rows, dtype=np.float64).reshape(-1, 5)
+        return {key: arr[:, i] for i, key in enumerate(['lat', 'lng', 'dest_lat', 'dest_lng', 'duration'])}
+
+    def get_stats(self):
+        """Returns the hit and miss counters of the store."""
+        with self._lock:
+            n_lookups = self.n_hits + self.n_misses
+            return {
+                'n_hits': self.n_hits,
+                'n_misses': self.n_misses,
+                'hit_rate': round(self.n_hits / n_lookups, 3) if n_lookups > 0 else None
+            }